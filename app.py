@@ -2,7 +2,7 @@ import streamlit as st
 import pandas as pd
 import sys
 import random
-from base import SQLiteScribe
+from base import SQLiteScribe, Blob
 
 @st.cache_resource
 def load_scribe(project_name):
@@ -14,12 +14,13 @@ def create_merged_dataframe(_scribe):
     data = []
     for id in all_ids:
         world_data = _scribe.find(key='world', id=id)
-        idea_data = _scribe.find(key='idea', id=id)
-        vars_data = _scribe.find(key='vars', id=id)
+        idea_data = _scribe.find_meta(key='idea', id=id)
         
         if world_data:
             _, _, world_payload, _ = world_data[0]
-            _, _, _, idea_meta = idea_data[0] if idea_data else (None, None, None, {})
+            _, _, idea_meta = idea_data[0] if idea_data else (None, None, {})
+            # fanned-out samples point back at the id their vars were generated under
+            vars_data = _scribe.find(key='vars', id=idea_meta.get('parent', id))
             _, _, vars_payload, _ = vars_data[0] if vars_data else (None, None, {}, None)
             
             data.append({
@@ -38,7 +39,7 @@ def find_world_by_id(merged_df, world_id):
 
 @st.cache_data
 def get_available_images(_scribe):
-    return [id for _, id, _, _ in _scribe.find(key='image')]
+    return set(_scribe.find_ids(key='image', done=True))
 
 def main():
     st.set_page_config(page_title='Altered Worlds', layout="wide")
@@ -102,9 +103,12 @@ def main():
     available_images = get_available_images(scribe)
     if selected_world.id in available_images:
         image_data, _ = scribe.load('image', selected_world.id)
-        # create <img> tag from base64 encoded data
-        img_tag = f'<center><img src="data:image/png;base64,{image_data}" style="width:auto;height:100%;"></center>'
-        st.markdown(img_tag, unsafe_allow_html=True)
+        if isinstance(image_data, Blob):
+            st.image(image_data.path)
+        else:
+            # legacy rows hold base64 encoded data, create <img> tag from it
+            img_tag = f'<center><img src="data:image/png;base64,{image_data}" style="width:auto;height:100%;"></center>'
+            st.markdown(img_tag, unsafe_allow_html=True)
     else:
         st.warning(f"No image found for World ID {selected_world.id}")
             
@@ -3,6 +3,16 @@ import json
 import copy
 from concurrent.futures import ThreadPoolExecutor
 import sqlite3
+import threading
+import queue
+import asyncio
+import hashlib
+import mmap
+import os
+import socket
+import uuid
+from metrics import METRICS
+from payload_codec import PayloadCodecs
 
 SAMPLER = {
     'temperature': 1.0,
@@ -12,10 +22,228 @@ SAMPLER = {
     'min_tokens': 10 
 }
 
+# JSON encodings of payloads that do not count as finished work (mirrors `if payload`).
+EMPTY_PAYLOADS = ('null', 'false', '0', '0.0', '""', '[]', '{}')
+
+# Seconds a claim stays valid without a heartbeat before other workers may take it over.
+LEASE_SECONDS = float(os.getenv('SCRIBE_LEASE_SECONDS', '60'))
+
+class Blob():
+    # Lazy handle to a payload kept out-of-row in a BlobStore; nothing is read until asked for.
+    def __init__(self, store, hash, size):
+        self.store = store
+        self.hash = hash
+        self.size = size
+
+    @property
+    def path(self):
+        return self.store.path(self.hash)
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def mmap(self):
+        with open(self.path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def ref(self):
+        return { '$blob': self.hash, 'size': self.size }
+
+    def __repr__(self):
+        return f'Blob({self.hash[:12]}, {self.size} bytes)'
+
+class BlobStore():
+    # Content-addressed files under {project}.blobs/, named by sha256 so identical outputs are stored once.
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, hash):
+        return os.path.join(self.root, hash[:2], hash)
+
+    def put(self, data):
+        hash = hashlib.sha256(data).hexdigest()
+        path = self.path(hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # pid and a uuid, thread idents repeat across the processes that may share a project's blobs
+            tmp = f'{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return Blob(self, hash, len(data))
+
+    def pack(self, payload):
+        if isinstance(payload, (bytes, bytearray, memoryview)): return self.put(bytes(payload)).ref()
+        if isinstance(payload, Blob): return payload.ref()
+        return payload
+
+    def unpack(self, payload):
+        if isinstance(payload, dict) and '$blob' in payload: return Blob(self, payload['$blob'], payload.get('size'))
+        return payload
+
+class PendingIndex():
+    # Incremental (key, id) index: which ids exist per key, which have a finished payload,
+    # and for each (inkey, outkey) pair which ids are done on the input side but absent on the output side.
+    # Keys are loaded lazily from the backend on first use, so the index is rebuilt after a restart.
+    # Per key it can also count rows by the model in their meta (fan-out parent markers left out) for model_max.
+    def __init__(self, scan, scan_models):
+        self.scan = scan
+        self.scan_models = scan_models
+        self.lock = threading.RLock()
+        self.ids = {}
+        self.done = {}
+        self.pending = {}
+        self.models = {}
+        self.model_counts = {}
+
+    def _load(self, key):
+        if key not in self.ids:
+            ids, done = self.scan(key)
+            self.ids[key] = set(ids)
+            self.done[key] = set(done)
+
+    def _pending(self, inkey, outkey):
+        pair = (inkey, outkey)
+        if pair not in self.pending:
+            self._load(inkey)
+            self._load(outkey)
+            self.pending[pair] = self.done[inkey] - self.ids[outkey]
+        return self.pending[pair]
+
+    def _select(self, ids, exclude, limit):
+        # walks only as far as needed to collect limit ids, so cost follows the work handed out
+        selected = []
+        for id in ids:
+            if limit is not None and len(selected) >= limit: break
+            if id not in exclude: selected.append(id)
+        return selected
+
+    def pending_ids(self, inkey, outkey, exclude = (), limit = None):
+        with self.lock:
+            return self._select(self._pending(inkey, outkey), exclude, limit)
+
+    def pending_count(self, inkey, outkey, exclude = ()):
+        with self.lock:
+            pending = self._pending(inkey, outkey)
+            # set intersection walks the smaller side, exclude (everything tried this run) keeps growing
+            return len(pending) - len(pending & (exclude if isinstance(exclude, (set, frozenset)) else set(exclude)))
+
+    def done_ids(self, key, exclude = (), limit = None):
+        with self.lock:
+            self._load(key)
+            return self._select(self.done[key], exclude, limit)
+
+    def done_count(self, key):
+        with self.lock:
+            self._load(key)
+            return len(self.done[key])
+
+    def _load_models(self, key):
+        if key not in self.models:
+            self.models[key] = {}
+            self.model_counts[key] = {}
+            for id, model in self.scan_models(key): self._set_model(key, id, model)
+
+    def _set_model(self, key, id, model):
+        # model None takes the id out of the counts
+        counts = self.model_counts[key]
+        old = self.models[key].pop(id, None)
+        if old is not None: counts[old] -= 1
+        if model is not None:
+            self.models[key][id] = model
+            counts[model] = counts.get(model, 0) + 1
+
+    def model_count(self, key, model):
+        with self.lock:
+            self._load_models(key)
+            return self.model_counts[key].get(model, 0)
+
+    def on_start(self, key, id):
+        with self.lock:
+            if key in self.ids: self.ids[key].add(id)
+            for (inkey, outkey), pending in self.pending.items():
+                if outkey == key: pending.discard(id)
+
+    def on_end(self, key, id, payload, meta = None):
+        with self.lock:
+            if key in self.models: self._set_model(key, id, meta.get('model') if isinstance(meta, dict) and 'children' not in meta else None)
+            if key not in self.ids: return
+            self.ids[key].add(id)
+            if not payload:
+                self.done[key].discard(id)
+                return
+            self.done[key].add(id)
+            for (inkey, outkey), pending in self.pending.items():
+                if inkey == key and id not in self.ids[outkey]: pending.add(id)
+
+    def invalidate(self):
+        # drop everything loaded so far, the next lookup rescans the backend
+        with self.lock:
+            self.ids = {}
+            self.done = {}
+            self.pending = {}
+            self.models = {}
+            self.model_counts = {}
+
+    def on_abort(self, key, id):
+        with self.lock:
+            if key in self.models: self._set_model(key, id, None)
+            if key in self.ids:
+                self.ids[key].discard(id)
+                self.done[key].discard(id)
+            for (inkey, outkey), pending in self.pending.items():
+                if inkey == key: pending.discard(id)
+                if outkey == key and id in self.done[inkey]: pending.add(id)
+
+class FanOut(list):
+    # Returned by run() in place of a single output when a step produced several samples for one input.
+    pass
+
+class AsyncLoop():
+    # A single asyncio event loop on a background thread, shared by every async step so one
+    # OS thread can keep thousands of network requests in flight.
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=16))
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+class AsyncStepQueue():
+    # Executor-like front for one step on the shared loop: submit() returns a concurrent.futures.Future
+    # and the semaphore caps the step at its parallel setting.
+    def __init__(self, event_loop, num_parallel):
+        self.loop = event_loop.loop
+        self.semaphore = asyncio.run_coroutine_threadsafe(self._semaphore(num_parallel), self.loop).result()
+
+    async def _semaphore(self, num_parallel):
+        return asyncio.Semaphore(num_parallel)
+
+    def submit(self, fn, *args):
+        return asyncio.run_coroutine_threadsafe(fn(*args), self.loop)
+
+    def shutdown(self, wait=True):
+        pass
+
 class Scribe():
     def __init__(self, project):
         self.project = project       
         self.steps = []
+        self.index = PendingIndex(self._scan_ids, self._scan_models)
+        self.blobs = BlobStore(f'{project}.blobs')
+        self.codecs = PayloadCodecs(os.path.join(f'{project}.blobs', 'dictionaries'))
+        self.wakeup = threading.Event()
+        self.event_loop = None
+        self.cache = None
+        self.gauges_published = 0
+        # 'depth' fills steps nearest the sink first and holds generators at their watermark, 'breadth' fills in step order
+        self.schedule = 'depth'
+        # claims carry an owner and a lease, renewed by the heartbeat thread while run_all_steps() is active
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.lease = LEASE_SECONDS
+        self.heartbeat = None
+        self.heartbeat_stop = threading.Event()
+        self.reclaimed = queue.Queue()
         
     def add_step(self, step):
         assert step.step not in self.steps
@@ -32,6 +260,10 @@ class Scribe():
     def db_abort(self, key, id):
         pass
 
+    def db_delete(self, key, ids):
+        # removes finished rows as well, unlike db_abort which only releases a claim
+        pass
+
     def load(self, key, id):
         pass
 
@@ -43,35 +275,286 @@ class Scribe():
 
     def all_ids(self):
         pass
-        
-    def _execute_single_step(self, st, id, input):
-        step_name = st.step
-        print(f"> {step_name} executing {id}")
+
+    def find_ids(self, key, done=False):
+        return [id for _, id, payload, _ in self.find(key=key) if payload or not done]
+
+    def load_many(self, key, ids):
+        return { id: self.load(key, id)[0] for id in ids }
+
+    def load_meta_many(self, key, ids):
+        return { id: meta for _, id, meta in (row for id in ids for row in self.find_meta(key=key, id=id)) }
+
+    def db_batch(self, key, rows):
+        # claim and finish many (id, payload, meta) rows at once, returns the ids actually written
+        written = []
+        for id, payload, meta in rows:
+            if self.db_start(key, id):
+                self.db_end(key, id, payload, meta)
+                written.append(id)
+        return written
+
+    def find_meta(self, key=None, id=None):
+        return [(key, id, meta) for key, id, _, meta in self.find(key=key, id=id)]
+
+    def count(self, key, done=False):
+        return len(self.find_ids(key, done))
+
+    def exists(self, key, id):
+        return len(self.find(key=key, id=id)) > 0
+
+    def _scan_ids(self, key):
+        return self.find_ids(key), self.find_ids(key, done=True)
+
+    def _scan_models(self, key):
+        return [(id, meta.get('model')) for _, id, meta in self.find_meta(key=key) if isinstance(meta, dict) and 'children' not in meta]
+
+    def pending_ids(self, inkey, outkey, exclude = (), limit = None):
+        return self.index.pending_ids(inkey, outkey, exclude, limit)
+
+    def pending_count(self, inkey, outkey, exclude = ()):
+        return self.index.pending_count(inkey, outkey, exclude)
+
+    def done_ids(self, key, exclude = (), limit = None):
+        return self.index.done_ids(key, exclude, limit)
+
+    def done_count(self, key):
+        return self.index.done_count(key)
+
+    def model_count(self, key, model):
+        return self.index.model_count(key, model)
+
+    def set_codec(self, key, spec, dictionary = None):
+        # payloads of key are stored with this codec from now on, rows already stored keep theirs
+        self.codecs.configure(key, spec, dictionary)
+
+    def encode_payload(self, key, payload):
+        return self.codecs.encode(key, self.blobs.pack(payload))
+
+    def decode_payload(self, raw):
+        return self.blobs.unpack(self.codecs.decode(raw))
+
+    def renew_leases(self):
+        pass
+
+    def reclaim_expired(self, orphans = False):
+        # returns the (key, id) claims it released back to pending
+        return []
+
+    def other_workers(self):
+        # number of other processes currently holding claims on this backend
+        return 0
+
+    def _sweep(self, orphans = False):
+        self.renew_leases()
+        reclaimed = self.reclaim_expired(orphans)
+        if len(reclaimed) > 0:
+            print(f"Reclaimed {len(reclaimed)} expired claims")
+            for claim in reclaimed: self.reclaimed.put(claim)
+        if self.other_workers() > 0:
+            # the index only tracks this process's writes, rescan to pick up what the other workers finished
+            self.index.invalidate()
+            self.notify()
+        elif len(reclaimed) > 0:
+            self.notify()
+
+    def _heartbeat(self):
+        while not self.heartbeat_stop.wait(self.lease / 3):
+            try:
+                self._sweep()
+            except Exception as e:
+                print(f"ERROR: lease heartbeat failed: {str(e)}")
+
+    def _start_heartbeat(self):
+        if self.heartbeat is not None: return
+        # the first sweep also releases placeholders left without a lease, before anything is scheduled
+        self._sweep(orphans=True)
+        self.heartbeat_stop.clear()
+        self.heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        self.heartbeat.start()
+
+    def _stop_heartbeat(self):
+        if self.heartbeat is None: return
+        self.heartbeat_stop.set()
+        self.heartbeat.join()
+        self.heartbeat = None
+
+    def _requeue_reclaimed(self):
+        # reclaimed ids may have been tried (and skipped as taken) earlier in this run, make them eligible again
+        while not self.reclaimed.empty():
+            key, id = self.reclaimed.get()
+            for st in self.steps:
+                if st.outkey == key: st.queued.discard(id)
+
+    def _begin_step(self, st, id):
+        print(f"> {st.step} executing {id}")
         if st.outkey is not None:
             if not self.db_start(st.outkey, id):
-                print(f"ERROR: {step_name} for {id} already exists")
-                return
+                print(f"ERROR: {st.step} for {id} already exists")
+                METRICS.inc('scribe_jobs_total', step=st.step, outcome='skipped')
+                return False
+        METRICS.add('scribe_jobs_running', 1, step=st.step)
+        return True
+
+    def _complete_step(self, st, id, output, meta):
+        # returns the job outcome for metrics: succeeded or aborted
+        if isinstance(output, FanOut):
+            return self._complete_fan_out(st, id, output, meta)
+        elif st.outkey is None:
+            # steps without an outkey record nothing
+            return 'succeeded'
+        elif output is not None:
+            self.db_end(st.outkey, id, output, meta)
+            return 'succeeded'
+        else:
+            print(f"ERROR: {st.step} for {id} returned nothing.")
+            self.db_abort(st.outkey, id)
+            return 'aborted'
+
+    def _complete_fan_out(self, st, id, outputs, meta):
+        # each sample becomes its own id in outkey with lineage in meta; the parent id keeps a null-payload
+        # marker row listing its children, so it is never pending again and downstream steps skip it
+        rows = [(f'{id}.{i}', output, { **meta, 'parent': id, 'sample': i }) for i, output in enumerate(outputs) if output is not None]
+        if len(rows) == 0:
+            print(f"ERROR: {st.step} for {id} returned nothing.")
+            self.db_abort(st.outkey, id)
+            return 'aborted'
+        children = self.db_batch(st.outkey, rows)
+        self.db_end(st.outkey, id, None, { **meta, 'children': children })
+        return 'succeeded'
+
+    def _crash_step(self, st, id, e):
+        print(f"ERROR: _execute_single_step {st.step} crashed: {str(e)}")
+        if st.outkey is not None: self.db_abort(st.outkey, id)
+        return 'error'
+
+    def _finish_job(self, st, outcome, started, count = 1):
+        METRICS.add('scribe_jobs_running', -count, step=st.step)
+        METRICS.inc('scribe_jobs_total', count, step=st.step, outcome=outcome)
+        METRICS.observe('scribe_job_seconds', time.time() - started, step=st.step, outcome=outcome)
+        if st.limiter is not None: st.limiter.on_sample(time.time() - started, outcome != 'error')
+
+    def enable_cache(self, path = None, max_bytes = None):
+        from output_cache import OutputCache, DEFAULT_CACHE_PATH
+        self.cache = OutputCache(path or DEFAULT_CACHE_PATH, **({'max_bytes': max_bytes} if max_bytes else {}))
+        print(f"Output cache enabled at {self.cache.path}")
+
+    def _cache_lookup(self, st, input):
+        # returns (cache key or None, cached (output, meta) or None)
+        if self.cache is None or not st.is_cacheable(): return None, None
+        key = self.cache.key(st.cache_key(input))
+        hit = self.cache.get(key)
+        if hit is not None: hit = (hit[0], { **hit[1], 'cached': True })
+        return key, hit
+
+    def _cache_store(self, key, output, meta):
+        if key is not None and output is not None and not isinstance(output, FanOut):
+            self.cache.put(key, output, meta)
+
+    def _execute_single_step(self, st, id, input):
+        if not self._begin_step(st, id): return
+        started = time.time()
         try:
-            output, meta = st.run(id, input)
-            if output is not None or st.outkey is None:
-                self.db_end(st.outkey, id, output, meta)
+            key, hit = self._cache_lookup(st, input)
+            if hit is not None:
+                output, meta = hit
             else:
-                print(f"ERROR: {step_name} for {id} returned nothing.")
-                self.db_abort(st.outkey, id)
+                output, meta = st.run(id, input)
+                self._cache_store(key, output, meta)
+            outcome = self._complete_step(st, id, output, meta)
         except Exception as e:
-            print(f"ERROR: _execute_single_step {step_name} crashed: {str(e)}")
-            self.db_abort(st.outkey, id)
+            outcome = self._crash_step(st, id, e)
+        self._finish_job(st, outcome, started)
+
+    def _execute_batch(self, st, ids):
+        print(f"> {st.step} executing batch of {len(ids)}")
+        # a batch is timed as one job; outcomes are still counted per id
+        METRICS.add('scribe_jobs_running', len(ids), step=st.step)
+        started = time.time()
+        try:
+            written = self._run_batch(st, ids)
+        except Exception as e:
+            # nothing reads the future of a batch, so the failure is reported here; the ids hold no claims to release
+            print(f"ERROR: {st.step} batch crashed: {str(e)}")
+            self._finish_job(st, 'error', started, len(ids))
+            return
+        self._finish_job(st, 'succeeded', started, len(written))
+        if len(written) < len(ids): self._finish_job(st, 'aborted', started, len(ids) - len(written))
+
+    def _run_batch(self, st, ids):
+        inputs = self.load_many(st.inkey, ids)
+        lookups = { id: self._cache_lookup(st, inputs.get(id)) for id in ids }
+        misses = [id for id in ids if lookups[id][1] is None]
+        computed = dict(zip(misses, st.run_batch([(id, inputs.get(id)) for id in misses])))
+        for id, (output, meta) in computed.items(): self._cache_store(lookups[id][0], output, meta)
+        # steps without an outkey record nothing, every id they were handed counts as done
+        if st.outkey is None: return ids
+        results = [computed[id] if id in computed else lookups[id][1] for id in ids]
+        rows = []
+        fanned_out = []
+        for id, (output, meta) in zip(ids, results):
+            if isinstance(output, FanOut):
+                # samples keep the single-item lineage layout, written per id
+                if self._complete_fan_out(st, id, output, meta) == 'succeeded': fanned_out.append(id)
+            elif output is None:
+                print(f"ERROR: {st.step} for {id} returned nothing.")
+            else:
+                rows.append((id, output, meta))
+        written = self.db_batch(st.outkey, rows)
+        if len(written) < len(rows): print(f"ERROR: {st.step} {len(rows)-len(written)} outputs already exist")
+        return written + fanned_out
+
+    async def _execute_single_step_async(self, st, id, input):
+        # same lifecycle as _execute_single_step; blocking db calls are pushed off the event loop
+        async with st.queue.semaphore:
+            if not await asyncio.to_thread(self._begin_step, st, id): return
+            started = time.time()
+            try:
+                key, hit = await asyncio.to_thread(self._cache_lookup, st, input)
+                if hit is not None:
+                    output, meta = hit
+                else:
+                    output, meta = await st.arun(id, input)
+                    await asyncio.to_thread(self._cache_store, key, output, meta)
+                outcome = await asyncio.to_thread(self._complete_step, st, id, output, meta)
+            except Exception as e:
+                outcome = await asyncio.to_thread(self._crash_step, st, id, e)
+            self._finish_job(st, outcome, started)
             
     def _create_work_thread(self, st):
-        num_parallel = int(st.params.get('parallel', '1'))            
-        st.queue = ThreadPoolExecutor(max_workers=num_parallel)
+        num_parallel = st.num_workers()
+        if st.is_async():
+            if self.event_loop is None: self.event_loop = AsyncLoop()
+            st.queue = AsyncStepQueue(self.event_loop, num_parallel)
+        else:
+            st.queue = ThreadPoolExecutor(max_workers=num_parallel)
     
     def _queue_work(self, st, id, input):
         assert st.queue != None
-        future = st.queue.submit(self._execute_single_step, st, id, input)
+        if st.is_async():
+            future = st.queue.submit(self._execute_single_step_async, st, id, input)
+        else:
+            future = st.queue.submit(self._execute_single_step, st, id, input)
         st.futures[id] = future
+        st.queued.add(id)
+        METRICS.inc('scribe_jobs_queued_total', step=st.step)
+        if st.limiter is not None:
+            st.limiter.started()
+            future.add_done_callback(lambda f: st.limiter.finished())
+        future.add_done_callback(lambda f: self.wakeup.set())
         return future
     
+    def _queue_batch(self, st, ids):
+        assert st.queue != None
+        future = st.queue.submit(self._execute_batch, st, ids)
+        # one future per batch, keyed by its first id so unfinished_futures() counts batches
+        future.ids = ids
+        st.futures[ids[0]] = future
+        st.queued.update(ids)
+        METRICS.inc('scribe_jobs_queued_total', len(ids), step=st.step)
+        future.add_done_callback(lambda f: self.wakeup.set())
+        return future
+
     def _unfinished_futures(self, st):
         if st.queue is None: return []
         return [future for id, future in st.futures.items() if not future.done()]
@@ -80,63 +563,127 @@ class Scribe():
         if st.queue is None: return
         for future in st.futures.values(): future.result()
         st.queue.shutdown(wait=True)
+        st.finish()
         st.queue = None
         st.futures = {}
+        st.queued = set()
     
     def shutdown(self):
         for st in self.steps:
             self._join_work_thread(st)
+        self._stop_heartbeat()
+        if self.cache is not None: print(f"Output cache: {self.cache.stats()}")
 
-    def run_all_steps(self, small_delay = 0.1, big_delay = 5):
-        while True:
-            did_work = False
-            next_steps = []
-            
-            for step in self.steps:
-                # print(f"--> {step.step}")
-                if step.queue_full(): 
-                    print(f'{step.step} queue is full')
-                    next_steps.insert(0, step)
-                    continue
-                
+    def notify(self):
+        self.wakeup.set()
+
+    def serve_metrics(self, port):
+        return METRICS.serve(port)
+
+    def _publish_gauges(self, interval = 1.0):
+        # backlog is a count query per step, so gauges are refreshed at most once per interval from the scheduler thread
+        if time.time() - self.gauges_published < interval: return
+        self.gauges_published = time.time()
+        for st in self.steps:
+            METRICS.set('scribe_queue_depth', len(st.unfinished_futures()), step=st.step)
+            try:
+                METRICS.set('scribe_backlog', st.backlog(), step=st.step)
+            except Exception:
+                pass
+
+    def _downstream(self, step):
+        # every step fed by this step's output, directly or through other steps
+        found, frontier = [], {step.outkey}
+        while len(frontier) > 0:
+            fed = [st for st in self.steps if st.inkey in frontier and st is not step and st not in found]
+            found += fed
+            frontier = {st.outkey for st in fed if st.outkey is not None}
+        return found
+
+    def _depth(self, step, seen = ()):
+        producers = [st for st in self.steps if st.outkey is not None and st.outkey == step.inkey and st not in seen]
+        return 1 + max((self._depth(st, (*seen, step)) for st in producers), default=-1)
+
+    def _schedule_order(self):
+        if self.schedule != 'depth': return self.steps
+        return sorted(self.steps, key=lambda st: -self._depth(st))
+
+    def _headroom(self, step):
+        # How many new ids the step may admit. Under depth-first scheduling a generator only tops up the work held
+        # by the steps below it to its watermark (default: twice their combined queue capacity), so samples reach
+        # the sink at a steady rate instead of the first stage running far ahead of the rest.
+        watermark = step.watermark()
+        if watermark is None and (self.schedule != 'depth' or step.inkey is not None): return None
+        downstream = self._downstream(step)
+        if len(downstream) == 0: return None
+        if watermark is None: watermark = 2 * sum(st.queue_capacity() for st in downstream)
+        headroom = watermark - sum(st.work_in_progress() for st in downstream)
+        # top up in chunks of a quarter watermark, each generator fill costs a count query
+        return headroom if headroom >= watermark // 4 else 0
+
+    def _fill_step(self, step):
+        num_queued = 0
+        headroom = self._headroom(step) if not step.queue_full() else None
+        while not step.queue_full():
+            free_slots = step.queue_capacity() - len(step.unfinished_futures())
+            limit = free_slots * step.batch_size() if step.is_batch() else free_slots
+            if headroom is not None: limit = min(limit, headroom - num_queued)
+            if limit <= 0: break
+            try:
+                pending_ids = step.pending_ids(limit=limit)
+            except Exception as e:
+                print(f"ERROR: pending_ids failed on {step.step}: {str(e)}")
+                break
+            if len(pending_ids) == 0: break
+
+            if step.is_batch():
+                for i in range(0, len(pending_ids), step.batch_size()):
+                    self._queue_batch(step, pending_ids[i:i+step.batch_size()])
+                num_queued += len(pending_ids)
+                print(f'{step.step} queued {len(pending_ids)} jobs in batches, still pending {step.backlog()}.')
+                continue
+
+            for id in pending_ids:
                 try:
-                    pending_inputs = list(step.pending_inputs())
+                    self._queue_work(step, id, step.load_input(id))
+                    num_queued += 1
                 except Exception as e:
-                    print(f"ERROR: pending_inputs failed on {step.step}: {str(e)}")
-                    pending_inputs = []
-                   
-                if len(pending_inputs) > 0:
-                    id, input = pending_inputs[0]
-                    print(f'{step.step} queued job {id}, still pending {len(pending_inputs)-1}.')
-                    try:
-                        self._queue_work(step, id, input)
-                    except Exception as e:
-                        print(f"ERROR: _queue_work failed on {step.step}: {str(e)}")
-                    did_work = True
-                    next_steps.append(step)
-                else:
-                    next_steps.insert(0, step)
+                    print(f"ERROR: _queue_work failed on {step.step}: {str(e)}")
+                    return num_queued
+            print(f'{step.step} queued {len(pending_ids)} jobs, still pending {step.backlog()}.')
+        return num_queued
 
-            self.steps = next_steps
-                    
-            if did_work:
-                time.sleep(small_delay)
-                continue
-            else:            
-                for st in self.steps:
-                    num_unfinished = len(st.unfinished_futures())
-                    if num_unfinished > 0:
-                        print(f'{st.step} busy, queue depth {num_unfinished}...')
-                        did_work = True
-            
-            if did_work:        
-                time.sleep(big_delay)
+    def run_all_steps(self, poll_interval = None):
+        # Event driven: a pass fills every step up to its queue capacity, then we sleep until a job
+        # finishes or notify() is called. poll_interval optionally bounds the sleep to pick up external writers.
+        self._start_heartbeat()
+        while True:
+            self.wakeup.clear()
+            self._requeue_reclaimed()
+            # snapshot before filling: a job may finish mid-pass, which must not look like an idle pipeline
+            was_busy = any(len(st.unfinished_futures()) > 0 for st in self.steps)
+            did_work = False
+            for step in self._schedule_order():
+                if self._fill_step(step) > 0: did_work = True
+            self._publish_gauges()
+            if did_work: continue
+
+            if not was_busy and self.other_workers() > 0:
+                # stay around while other workers hold claims: their outputs feed our steps and their expired leases are ours to retry
+                print(f'Waiting on {self.other_workers()} other workers.')
+                self.wakeup.wait(self.lease / 3)
                 continue
 
-            # If there was no new work and there are no pending futures, the process is complete
-            print('Nothing left to do, shutting down.')
-            self.shutdown()
-            break
+            if not was_busy:
+                # If there was no new work and there are no pending futures, the process is complete
+                print('Nothing left to do, shutting down.')
+                self._publish_gauges(interval=0)
+                self.shutdown()
+                break
+
+            busy = [f'{st.step} busy, queue depth {len(st.unfinished_futures())}' for st in self.steps if len(st.unfinished_futures()) > 0]
+            if len(busy) > 0: print(', '.join(busy))
+            self.wakeup.wait(poll_interval)
 
     def init_pipeline(self, args, PIPELINE):
         STEPS = {x.step: x for x in PIPELINE}
@@ -160,62 +707,303 @@ class Scribe():
                     
                 self.add_step(new_step)
                 
+class SQLiteWriter():
+    # Group commit: a single writer thread owns the write connection and applies every queued
+    # operation in one transaction, so N concurrent db_start/db_end calls cost one commit.
+    # Callers block until the batch holding their write is committed.
+    def __init__(self, connect, max_batch = 512):
+        self.connect = connect
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def execute(self, sql, args):
+        results = self.execute_many([(sql, args)], ignore_conflicts=False)
+        return results[0]
+
+    def execute_many(self, statements, ignore_conflicts = True):
+        # All statements land in the same transaction. With ignore_conflicts an IntegrityError only
+        # skips its own statement (result None) instead of failing the call.
+        return self._submit({'statements': statements, 'ignore_conflicts': ignore_conflicts})
+
+    def call(self, fn):
+        # fn(db) runs inside the writer's transaction, for read-then-write operations that must be atomic
+        return self._submit({'fn': fn})
+
+    def _submit(self, op):
+        op.update({'done': threading.Event(), 'results': [], 'error': None})
+        self.queue.put(op)
+        op['done'].wait()
+        if op['error'] is not None: raise op['error']
+        return op['results']
+
+    def _run(self):
+        db = self.connect(isolation_level=None)
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            started = time.time()
+            try:
+                db.execute('BEGIN IMMEDIATE')
+                for op in batch:
+                    db.execute('SAVEPOINT op')
+                    try:
+                        if 'fn' in op: op['results'] = op['fn'](db)
+                        for sql, args in op.get('statements', []):
+                            try:
+                                op['results'].append(db.execute(sql, args).rowcount)
+                            except sqlite3.IntegrityError as e:
+                                if not op['ignore_conflicts']: raise
+                                op['results'].append(None)
+                        db.execute('RELEASE op')
+                    except Exception as e:
+                        db.execute('ROLLBACK TO op')
+                        db.execute('RELEASE op')
+                        op['error'] = e
+                db.execute('COMMIT')
+            except Exception as e:
+                if db.in_transaction: db.execute('ROLLBACK')
+                for op in batch: op['error'] = e
+            METRICS.observe('scribe_db_commit_seconds', time.time() - started)
+            METRICS.inc('scribe_db_commit_ops_total', len(batch))
+            METRICS.inc('scribe_db_commits_total')
+            for op in batch: op['done'].set()
+
 class SQLiteScribe(Scribe):
+    PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': '-65536',
+        'temp_store': 'MEMORY',
+        'busy_timeout': '30000'
+    }
+
     def __init__(self, project):
         super().__init__(project)
         
         self.dbname = f'{project}.db'
         
-        self.db = sqlite3.connect(self.dbname)
+        self.db = self._connect()
         self.db.execute('''CREATE TABLE IF NOT EXISTS data
                            (key TEXT, id TEXT, payload TEXT, meta TEXT,
                             PRIMARY KEY (key, id))''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS claims
+                           (key TEXT, id TEXT, owner TEXT, expires REAL,
+                            PRIMARY KEY (key, id))''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS claims_expires ON claims (expires)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS claims_owner ON claims (owner)')
         self.db.commit()
+
+        self.local = threading.local()
+        self.writer = SQLiteWriter(self._connect)
+
+    def _connect(self, **kwargs):
+        db = sqlite3.connect(self.dbname, timeout=30, **kwargs)
+        for k, v in self.PRAGMAS.items():
+            db.execute(f'PRAGMA {k}={v}')
+        return db
+
+    def _reader(self):
+        # One long-lived read connection per thread; WAL lets readers proceed while the writer commits.
+        if not hasattr(self.local, 'db'): self.local.db = self._connect()
+        return self.local.db
            
+    @METRICS.timed('scribe_db_seconds', op='db_start')
     def db_start(self, key, id):
-        try:
-            with sqlite3.connect(self.dbname) as db:
-                db.execute('INSERT INTO data (key, id, payload, meta) VALUES (?, ?, ?, ?)', (key, id, 'null', 'null'))
+        claimed = self.writer.call(lambda db: self._claim(db, key, id))
+        if claimed: self.index.on_start(key, id)
+        return claimed
+
+    def _claim(self, db, key, id):
+        # A claim is the usual 'null' placeholder row plus a lease in claims, written in one transaction.
+        # An existing row is only taken over when its lease has expired, or when it is an unfinished
+        # placeholder without any lease (left behind by a crashed process from before leases).
+        expires = time.time() + self.lease
+        if db.execute('INSERT OR IGNORE INTO data (key, id, payload, meta) VALUES (?, ?, ?, ?)', (key, id, 'null', 'null')).rowcount == 1:
+            db.execute('INSERT OR REPLACE INTO claims (key, id, owner, expires) VALUES (?, ?, ?, ?)', (key, id, self.owner, expires))
+            return True
+        if db.execute('UPDATE claims SET owner = ?, expires = ? WHERE key = ? AND id = ? AND expires < ?', (self.owner, expires, key, id, time.time())).rowcount == 1:
             return True
-        except sqlite3.IntegrityError:
-            return False
+        if db.execute(self.ORPHAN_SQL + ' AND key = ? AND id = ?', (key, id)).fetchone() is not None:
+            db.execute('INSERT INTO claims (key, id, owner, expires) VALUES (?, ?, ?, ?)', (key, id, self.owner, expires))
+            return True
+        return False
+
+    # unfinished placeholder rows that nobody holds a lease on; fan-out parents have a null payload but carry meta
+    ORPHAN_SQL = '''SELECT key, id FROM data WHERE payload = 'null' AND meta = 'null'
+                    AND NOT EXISTS (SELECT 1 FROM claims WHERE claims.key = data.key AND claims.id = data.id)'''
 
+    UPSERT_SQL = '''INSERT INTO data (key, id, payload, meta) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (key, id) DO UPDATE SET payload = excluded.payload, meta = excluded.meta'''
+
+    @METRICS.timed('scribe_db_seconds', op='db_end')
     def db_end(self, key, id, payload, meta):
-        with sqlite3.connect(self.dbname) as db:
-            db.execute('UPDATE data SET payload = ?, meta = ? WHERE key = ? AND id = ?', 
-                       (json.dumps(payload), json.dumps(meta), key, id))
+        # an upsert, so a result that arrives after its lease was reclaimed is still kept
+        self.writer.execute_many([(self.UPSERT_SQL, (key, id, self.encode_payload(key, payload), json.dumps(meta))),
+                                  ('DELETE FROM claims WHERE key = ? AND id = ?', (key, id))], ignore_conflicts=False)
+        self.index.on_end(key, id, payload, meta)
 
+    @METRICS.timed('scribe_db_seconds', op='db_abort')
     def db_abort(self, key, id):
-        with sqlite3.connect(self.dbname) as db:
-            db.execute('DELETE FROM data WHERE key = ? AND id = ?', (key, id))
+        # only release a claim this process still holds, another worker may have taken over an expired lease
+        def abort(db):
+            released = db.execute('DELETE FROM claims WHERE key = ? AND id = ? AND owner = ?', (key, id, self.owner)).rowcount == 1
+            if released: db.execute("DELETE FROM data WHERE key = ? AND id = ? AND payload = 'null'", (key, id))
+            return released
+        # an id whose lease another worker took over is theirs now, it must not turn pending here again
+        if self.writer.call(abort): self.index.on_abort(key, id)
+
+    def other_workers(self):
+        cursor = self._reader().execute('SELECT COUNT(DISTINCT owner) FROM claims WHERE owner != ?', (self.owner,))
+        return cursor.fetchone()[0]
+
+    @METRICS.timed('scribe_db_seconds', op='db_delete')
+    def db_delete(self, key, ids):
+        statements = [(sql, (key, id)) for id in ids for sql in ('DELETE FROM data WHERE key = ? AND id = ?', 'DELETE FROM claims WHERE key = ? AND id = ?')]
+        for i in range(0, len(statements), 10000): self.writer.execute_many(statements[i:i+10000], ignore_conflicts=False)
+        for id in ids: self.index.on_abort(key, id)
+
+    def renew_leases(self):
+        self.writer.execute('UPDATE claims SET expires = ? WHERE owner = ?', (time.time() + self.lease, self.owner))
+
+    def reclaim_expired(self, orphans = False):
+        def reclaim(db):
+            rows = db.execute('SELECT key, id FROM claims WHERE expires < ?', (time.time(),)).fetchall()
+            # the orphan scan reads the whole table, so it only runs on the first heartbeat
+            if orphans: rows += db.execute(self.ORPHAN_SQL).fetchall()
+            for key, id in rows:
+                db.execute("DELETE FROM data WHERE key = ? AND id = ? AND payload = 'null' AND meta = 'null'", (key, id))
+                db.execute('DELETE FROM claims WHERE key = ? AND id = ?', (key, id))
+            return rows
+        reclaimed = self.writer.call(reclaim)
+        for key, id in reclaimed: self.index.on_abort(key, id)
+        return reclaimed
 
+    @METRICS.timed('scribe_db_seconds', op='db_batch')
+    def db_batch(self, key, rows):
+        statements = [('INSERT INTO data (key, id, payload, meta) VALUES (?, ?, ?, ?)', (key, id, self.encode_payload(key, payload), json.dumps(meta))) for id, payload, meta in rows]
+        results = self.writer.execute_many(statements)
+        written = []
+        for (id, payload, meta), result in zip(rows, results):
+            if result is None: continue
+            self.index.on_start(key, id)
+            self.index.on_end(key, id, payload, meta)
+            written.append(id)
+        return written
+
+    @METRICS.timed('scribe_db_seconds', op='load_many')
+    def load_many(self, key, ids):
+        db = self._reader()
+        payloads = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i+500]
+            cursor = db.execute(f'SELECT id, payload FROM data WHERE key = ? AND id IN ({",".join("?"*len(chunk))})', (key, *chunk))
+            payloads.update({ row[0]: self.decode_payload(row[1]) for row in cursor.fetchall() })
+        return payloads
+
+    @METRICS.timed('scribe_db_seconds', op='load_meta_many')
+    def load_meta_many(self, key, ids):
+        db = self._reader()
+        metas = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i+500]
+            cursor = db.execute(f'SELECT id, meta FROM data WHERE key = ? AND id IN ({",".join("?"*len(chunk))})', (key, *chunk))
+            metas.update({ row[0]: json.loads(row[1]) for row in cursor.fetchall() })
+        return metas
+
+    @METRICS.timed('scribe_db_seconds', op='load')
     def load(self, key, id):
-        with sqlite3.connect(self.dbname) as db:
-            cursor = db.execute('SELECT payload, meta FROM data WHERE key = ? AND id = ?', (key, id))
-            result = cursor.fetchone()
-        return (json.loads(result[0]), json.loads(result[1])) if result else (None, None)
+        cursor = self._reader().execute('SELECT payload, meta FROM data WHERE key = ? AND id = ?', (key, id))
+        result = cursor.fetchone()
+        return (self.decode_payload(result[0]), json.loads(result[1])) if result else (None, None)
 
+    @METRICS.timed('scribe_db_seconds', op='find')
     def find(self, key=None, id=None):
-        with sqlite3.connect(self.dbname) as db:
-            if key and id:
-                cursor = db.execute('SELECT key, id, payload, meta FROM data WHERE key = ? AND id = ?', (key, id))
-            elif key:
-                cursor = db.execute('SELECT key, id, payload, meta FROM data WHERE key = ?', (key,))
-            elif id:
-                cursor = db.execute('SELECT key, id, payload, meta FROM data WHERE id = ?', (id,))
-            else:
-                cursor = db.execute('SELECT key, id, payload, meta FROM data')
-        return [(row[0], row[1], json.loads(row[2]), json.loads(row[3])) for row in cursor.fetchall()]
+        db = self._reader()
+        if key and id:
+            cursor = db.execute('SELECT key, id, payload, meta FROM data WHERE key = ? AND id = ?', (key, id))
+        elif key:
+            cursor = db.execute('SELECT key, id, payload, meta FROM data WHERE key = ?', (key,))
+        elif id:
+            cursor = db.execute('SELECT key, id, payload, meta FROM data WHERE id = ?', (id,))
+        else:
+            cursor = db.execute('SELECT key, id, payload, meta FROM data')
+        return [(row[0], row[1], self.decode_payload(row[2]), json.loads(row[3])) for row in cursor.fetchall()]
+
+    def recode(self, key, chunk = 1000):
+        # rewrites the stored payloads of key with its current codec, returns total payload bytes before and after
+        before, after, last = 0, 0, 0
+        while True:
+            rows = self._reader().execute('SELECT rowid, id, payload FROM data WHERE key = ? AND rowid > ? ORDER BY rowid LIMIT ?', (key, last, chunk)).fetchall()
+            if len(rows) == 0: return before, after
+            last = rows[-1][0]
+            updates = []
+            for rowid, id, raw in rows:
+                encoded = self.codecs.encode(key, self.codecs.decode(raw))
+                before, after = before + len(raw), after + len(encoded)
+                if encoded != raw: updates.append(('UPDATE data SET payload = ? WHERE rowid = ?', (encoded, rowid)))
+            if len(updates) > 0: self.writer.execute_many(updates, ignore_conflicts=False)
 
     def all_keys(self):
-        with sqlite3.connect(self.dbname) as db:
-            cursor = db.execute('SELECT DISTINCT key FROM data')
+        cursor = self._reader().execute('SELECT DISTINCT key FROM data')
         return [row[0] for row in cursor.fetchall()]
 
     def all_ids(self):
-        with sqlite3.connect(self.dbname) as db:
-            cursor = db.execute('SELECT DISTINCT id FROM data')
+        cursor = self._reader().execute('SELECT DISTINCT id FROM data')
+        return [row[0] for row in cursor.fetchall()]
+
+    @METRICS.timed('scribe_db_seconds', op='find_ids')
+    def find_ids(self, key, done=False):
+        db = self._reader()
+        if done:
+            cursor = db.execute(f'SELECT id FROM data WHERE key = ? AND payload NOT IN ({",".join("?"*len(EMPTY_PAYLOADS))})', (key, *EMPTY_PAYLOADS))
+        else:
+            cursor = db.execute('SELECT id FROM data WHERE key = ?', (key,))
         return [row[0] for row in cursor.fetchall()]
+
+    @METRICS.timed('scribe_db_seconds', op='find_meta')
+    def find_meta(self, key=None, id=None):
+        db = self._reader()
+        if key and id:
+            cursor = db.execute('SELECT key, id, meta FROM data WHERE key = ? AND id = ?', (key, id))
+        elif key:
+            cursor = db.execute('SELECT key, id, meta FROM data WHERE key = ?', (key,))
+        elif id:
+            cursor = db.execute('SELECT key, id, meta FROM data WHERE id = ?', (id,))
+        else:
+            cursor = db.execute('SELECT key, id, meta FROM data')
+        return [(row[0], row[1], json.loads(row[2])) for row in cursor.fetchall()]
+
+    @METRICS.timed('scribe_db_seconds', op='count')
+    def count(self, key, done=False):
+        db = self._reader()
+        if done:
+            cursor = db.execute(f'SELECT COUNT(*) FROM data WHERE key = ? AND payload NOT IN ({",".join("?"*len(EMPTY_PAYLOADS))})', (key, *EMPTY_PAYLOADS))
+        else:
+            cursor = db.execute('SELECT COUNT(*) FROM data WHERE key = ?', (key,))
+        return cursor.fetchone()[0]
+
+    @METRICS.timed('scribe_db_seconds', op='exists')
+    def exists(self, key, id):
+        cursor = self._reader().execute('SELECT 1 FROM data WHERE key = ? AND id = ?', (key, id))
+        return cursor.fetchone() is not None
+
+    @METRICS.timed('scribe_db_seconds', op='scan_ids')
+    def _scan_ids(self, key):
+        cursor = self._reader().execute(f'SELECT id, payload NOT IN ({",".join("?"*len(EMPTY_PAYLOADS))}) FROM data WHERE key = ?', (*EMPTY_PAYLOADS, key))
+        rows = cursor.fetchall()
+        return [row[0] for row in rows], [row[0] for row in rows if row[1]]
+
+    @METRICS.timed('scribe_db_seconds', op='scan_models')
+    def _scan_models(self, key):
+        # json_extract in SQL, so a large key is counted without decoding every meta in Python
+        cursor = self._reader().execute("SELECT id, json_extract(meta, '$.model') FROM data WHERE key = ? AND json_type(meta) = 'object' AND json_extract(meta, '$.children') IS NULL", (key,))
+        return cursor.fetchall()
     
 if __name__ == "__main__":
     import argparse
@@ -231,6 +1019,10 @@ if __name__ == "__main__":
     
     print("\nAll ids:")
     print(sc.all_ids())
+
+    print("\nRows per key:")
+    for key in sc.all_keys():
+        print(key, sc.count(key), 'done:', sc.count(key, done=True))
     
     print("\nAll documents:")
     docs = sc.find()
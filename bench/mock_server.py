@@ -0,0 +1,166 @@
+# In-process stand-in for an OpenAI-compatible LLM server and the AUTOMATIC1111 txt2img API, so pipelines
+# can be benchmarked without a GPU. Every answer carries the JSON fields the bundled pipelines extract
+# (world_builder's World schema and code_challenge's challenge_N objects). Standalone:
+#
+#   python3 -m bench.mock_server --port 3333 --latency 0.2 --token-rate 50
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import argparse
+import random
+import base64
+import json
+import time
+
+# 1x1 transparent PNG
+PNG = base64.b64encode(bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+                                     '1f15c4890000000d49444154789c6360000002000005000100a5f645400000000049454e44ae426082')).decode()
+
+ANSWER = json.dumps({
+    'world_name': 'Benchmark World',
+    'concept': 'A world generated by the benchmark mock server.',
+    'description': 'Flat, evenly lit and perfectly predictable.',
+    'sensory': 'The hum of a request loop.',
+    'challenges_opportunities': 'Throughput.',
+    'twist': 'Nothing here is real.',
+    'story_seeds': ['A request that never returns.', 'A queue that never drains.'],
+    **{ f'challenge_{i}': { 'title': f'Challenge {i}', 'description': 'Implement a function.', 'concepts': 'benchmarks' } for i in range(3) }
+})
+
+class MockHTTPServer(ThreadingHTTPServer):
+    # the default listen backlog of 5 drops connections when hundreds of workers connect at once
+    request_queue_size = 1024
+    daemon_threads = True
+
+class MockServer():
+    def __init__(self, latency = 0.0, token_rate = 0.0, tokens = 256, error_rate = 0.0, error_status = 500, image_latency = None, capacity = 0, port = 0, host = '127.0.0.1'):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.image_latency = latency if image_latency is None else image_latency
+        self.lock = threading.Lock()
+        self.requests = {}
+        # capacity > 0 behaves like a GPU server with that many batch slots, further requests queue for a slot
+        self.slots = threading.Semaphore(capacity) if capacity > 0 else None
+        self.server = MockHTTPServer((host, port), self._handler())
+        self.url = f'http://{host}:{self.server.server_port}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.requests)
+
+    def _count(self, path):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def _text(self):
+        # roughly one token per word: filler first, the JSON answer last so extraction finds it
+        filler = max(0, self.tokens - len(ANSWER.split()))
+        return 'lorem ' * filler + ANSWER
+
+    def _decode_time(self, tokens):
+        return tokens / self.token_rate if self.token_rate > 0 else 0.0
+
+    def _choices(self, request, chat):
+        prompts = request.get('messages') if chat else request.get('prompt')
+        num_prompts = len(prompts) if not chat and isinstance(prompts, list) else 1
+        n = int(request.get('n', 1))
+        text = self._text()
+        if chat: return [{ 'index': i, 'message': { 'role': 'assistant', 'content': text }, 'finish_reason': 'stop' } for i in range(n)]
+        return [{ 'index': i, 'text': text, 'finish_reason': 'stop' } for i in range(num_prompts * n)]
+
+    def _handler(self):
+        mock = self
+
+        class MockHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, choices, chat):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                def chunk(payload):
+                    data = f'data: {payload}\n\n'.encode()
+                    self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+                    self.wfile.flush()
+                words = choices[0]['message']['content'].split(' ') if chat else choices[0]['text'].split(' ')
+                delay = mock._decode_time(1)
+                for i, word in enumerate(words):
+                    piece = word if i == len(words) - 1 else word + ' '
+                    for choice in choices:
+                        delta = { 'index': choice['index'], 'delta': { 'content': piece } } if chat else { 'index': choice['index'], 'text': piece }
+                        chunk(json.dumps({ 'choices': [delta] }))
+                    if delay: time.sleep(delay)
+                chunk(json.dumps({ 'choices': [], 'usage': { 'prompt_tokens': 0, 'completion_tokens': len(words) * len(choices) } }))
+                chunk('[DONE]')
+                self.wfile.write(b'0\r\n\r\n')
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                mock._count(self.path)
+                if self.path.endswith('/sdapi/v1/txt2img'):
+                    time.sleep(mock.image_latency)
+                    if random.random() < mock.error_rate: return self._send_json(mock.error_status, { 'error': 'injected' })
+                    return self._send_json(200, { 'images': [PNG] })
+                if not (self.path.endswith('/chat/completions') or self.path.endswith('/completions')):
+                    return self._send_json(404, { 'error': f'unknown path {self.path}' })
+
+                chat = self.path.endswith('/chat/completions')
+                if mock.slots is None: return self._complete(request, chat)
+                with mock.slots:
+                    self._complete(request, chat)
+
+            def _complete(self, request, chat):
+                time.sleep(mock.latency)
+                if random.random() < mock.error_rate: return self._send_json(mock.error_status, { 'error': 'injected' })
+                choices = mock._choices(request, chat)
+                if request.get('stream'): return self._stream(choices, chat)
+                time.sleep(mock._decode_time(mock.tokens))
+                self._send_json(200, { 'object': 'chat.completion' if chat else 'text_completion', 'choices': choices,
+                                       'usage': { 'prompt_tokens': 0, 'completion_tokens': mock.tokens * len(choices) } })
+
+        return MockHandler
+
+def add_mock_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before the first token of every LLM response")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="Decode speed in tokens/s per request, 0 for instant")
+    parser.add_argument("--tokens", type=int, default=256, help="Completion tokens per answer")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with --error-status")
+    parser.add_argument("--error-status", type=int, default=500, help="Status code for injected errors")
+    parser.add_argument("--image-latency", type=float, default=None, help="Seconds per txt2img request, defaults to --latency")
+    parser.add_argument("--capacity", type=int, default=0, help="Concurrent LLM requests served at once, the rest queue (0 for unlimited)")
+
+def mock_from_args(args, port = 0):
+    return MockServer(latency=args.latency, token_rate=args.token_rate, tokens=args.tokens, error_rate=args.error_rate,
+                      error_status=args.error_status, image_latency=args.image_latency, capacity=args.capacity, port=port)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock OpenAI / AUTOMATIC1111 server")
+    parser.add_argument("--port", type=int, default=3333)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    mock = mock_from_args(args, port=args.port)
+    print(f"Mock server on {mock.url} (OPENAI_BASE_URL={mock.url}/v1 IMAGE_API_URL={mock.url})")
+    mock.server.serve_forever()
@@ -0,0 +1,92 @@
+# Startup-cost benchmark: for every step of each entry point, start a fresh interpreter, import the
+# entry module and configure just that step, then record the time taken and which heavy dependencies
+# ended up imported. Run from the repository root:
+#
+#   python3 -m bench.startup --output startup.json
+#   python3 -m bench.startup --baseline startup.json     # exit 1 on regression
+import subprocess
+import tempfile
+import argparse
+import json
+import sys
+import os
+import time
+
+ENTRY_POINTS = ['world_builder', 'code_challenge']
+HEAVY_MODULES = ['transformers', 'torch', 'pydantic', 'nltk', 'aiohttp', 'pandas', 'streamlit', 'pyarrow', 'msgpack', 'zstandard']
+
+PROBE = '''
+import sys, time, json
+t0 = time.perf_counter()
+import {entry} as entry
+t1 = time.perf_counter()
+steps = {{st.step: type(st).__name__ for st in entry.PIPELINE}}
+if {step!r} is not None:
+    scr = entry.SQLiteScribe({project!r})
+    scr.init_pipeline([[{step!r}]], entry.PIPELINE)
+t2 = time.perf_counter()
+print(json.dumps({{'import_s': t1-t0, 'setup_s': t2-t1, 'steps': steps, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+def probe(entry, step, workdir):
+    project = os.path.join(workdir, f'{entry}-{step}')
+    code = PROBE.format(entry=entry, step=step, project=project, heavy=HEAVY_MODULES)
+    t0 = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    wall_s = time.perf_counter() - t0
+    if proc.returncode != 0:
+        return { 'entry': entry, 'step': step, 'error': proc.stderr.strip().splitlines()[-1] }
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    return { 'entry': entry, 'step': step, 'wall_s': wall_s, **result }
+
+def run_benchmark(entries):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for entry in entries:
+            base = probe(entry, None, workdir)
+            results.append(base)
+            for step, step_type in base.get('steps', {}).items():
+                results.append({ **probe(entry, step, workdir), 'type': step_type })
+    for r in results: r.pop('steps', None)
+    return results
+
+def compare(results, baseline, tolerance):
+    previous = { (r['entry'], r['step']): r for r in baseline }
+    regressions = []
+    for r in results:
+        old = previous.get((r['entry'], r['step']))
+        if old is None or 'error' in old: continue
+        if 'error' in r:
+            regressions.append(f"{r['entry']} {r['step']}: {r['error']}")
+            continue
+        if r['wall_s'] > old['wall_s'] * (1 + tolerance) + 0.05:
+            regressions.append(f"{r['entry']} {r['step']}: {old['wall_s']:.2f}s -> {r['wall_s']:.2f}s")
+        new_heavy = set(r['heavy']) - set(old['heavy'])
+        if new_heavy:
+            regressions.append(f"{r['entry']} {r['step']}: now imports {', '.join(sorted(new_heavy))}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scribe startup benchmark")
+    parser.add_argument("--entry", action="append", help="Entry point module(s) to probe, default all")
+    parser.add_argument("--output", type=str, help="Write results as JSON to this file")
+    parser.add_argument("--baseline", type=str, help="Compare against a previous --output file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative slowdown vs baseline")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.entry or ENTRY_POINTS)
+    for r in results:
+        if 'error' in r:
+            print(f"{r['entry']:<16} {str(r['step']):<12} ERROR {r['error']}")
+        else:
+            print(f"{r['entry']:<16} {str(r['step']):<12} {r.get('type', ''):<20} wall {r['wall_s']:.3f}s import {r['import_s']:.3f}s setup {r['setup_s']:.3f}s heavy: {', '.join(r['heavy']) or '-'}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions: print('REGRESSION:', line)
+        if regressions: sys.exit(1)
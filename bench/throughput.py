@@ -0,0 +1,174 @@
+# End-to-end throughput benchmark: runs the real PIPELINE of each entry point against the in-process
+# mock server (bench/mock_server.py) at several sample counts. Every case runs in a fresh interpreter
+# so peak RSS is per case. Run from the repository root:
+#
+#   python3 -m bench.throughput --samples 1000 10000 --output throughput.json
+#   python3 -m bench.throughput --baseline throughput.json     # exit 1 on regression
+import contextlib
+import subprocess
+import tempfile
+import argparse
+import resource
+import threading
+import json
+import sys
+import os
+import time
+
+from bench.mock_server import add_mock_arguments, mock_from_args
+
+ENTRY_POINTS = ['world_builder', 'code_challenge']
+SAMPLES = [1000, 10000, 100000]
+
+# stands in for the NLTK word lists (basic.txt/advanced.txt) when they have not been built
+BENCH_WORDS = ['amber', 'beacon', 'cinder', 'delta', 'ember', 'fable', 'glacier', 'harbor', 'ivory', 'juniper', 'kernel', 'lantern']
+
+def step_args(pipeline, samples, parallel, executor):
+    from steps import GenerateStep, StepLLMCompletion, StepText2Image
+    args = []
+    for st in pipeline:
+        if isinstance(st, GenerateStep):
+            args.append(f'{st.step}/max={samples}/parallel=8')
+        elif isinstance(st, (StepLLMCompletion, StepText2Image)):
+            args.append(f'{st.step}/model=bench/parallel={parallel}/executor={executor}')
+        else:
+            args.append(st.step)
+    return args
+
+def disk_usage(project):
+    paths = [f'{project}.db', f'{project}.db-wal', f'{project}.db-shm']
+    total = sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+    for directory in (f'{project}.blobs', f'{project}.log'):
+        for root, dirs, files in os.walk(directory):
+            total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+def step_summary(snapshot):
+    steps = {}
+    for c in snapshot['counters']:
+        if c['name'] != 'scribe_jobs_total': continue
+        outcomes = steps.setdefault(c['labels']['step'], { 'outcomes': {} })['outcomes']
+        outcomes[c['labels']['outcome']] = outcomes.get(c['labels']['outcome'], 0) + c['value']
+    for h in snapshot['histograms']:
+        if h['name'] != 'scribe_job_seconds' or h['labels'].get('outcome') != 'succeeded': continue
+        steps.setdefault(h['labels']['step'], { 'outcomes': {} }).update({ 'p50_s': h['p50'], 'p99_s': h['p99'], 'mean_s': h['sum'] / h['count'] })
+    return steps
+
+def run_case(entry, samples, args, workdir):
+    # executed inside the worker process: the mock must be up and the env vars set before the first request, when
+    # get_pool builds the default 'llm' and 'image' endpoint pools from OPENAI_BASE_URL and IMAGE_API_URL
+    mock = mock_from_args(args).start()
+    os.environ['OPENAI_BASE_URL'] = mock.url + '/v1'
+    os.environ['IMAGE_API_URL'] = mock.url
+
+    import language_tools
+    if not os.path.isfile('basic.txt'): language_tools.word_lists.update({ 'basic': BENCH_WORDS, 'advanced': BENCH_WORDS })
+    from metrics import METRICS
+    module = __import__(entry)
+
+    project = os.path.join(workdir, f'{entry}-{samples}')
+    from storage import SCRIBES
+    scr = SCRIBES[args.storage](project)
+    scr.schedule = args.schedule
+    # throughput counts finished rows of the last step that produces data, export markers are not samples
+    from steps import ExportStep
+    last_key = [st.outkey for st in module.PIPELINE if st.outkey is not None and not isinstance(st, ExportStep)][-1]
+    first_result = []
+    def watch_first_result(t0):
+        while len(first_result) == 0 and scr.index.done_count(last_key) == 0: time.sleep(0.05)
+        first_result.append(time.perf_counter() - t0)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        scr.init_pipeline([step_args(module.PIPELINE, samples, args.parallel, args.executor)], module.PIPELINE)
+        t0 = time.perf_counter()
+        threading.Thread(target=watch_first_result, args=(t0,), daemon=True).start()
+        scr.run_all_steps()
+        elapsed = time.perf_counter() - t0
+
+    completed = scr.count(last_key, done=True)
+    return {
+        'entry': entry,
+        'samples': samples,
+        'completed': completed,
+        'elapsed_s': elapsed,
+        'samples_per_s': completed / elapsed if elapsed else None,
+        'first_result_s': first_result[0] if first_result else None,
+        'db_bytes': disk_usage(project),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'requests': mock.stats(),
+        'steps': step_summary(METRICS.snapshot())
+    }
+
+def run_benchmark(entries, sample_counts, worker_args):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for entry in entries:
+            for samples in sample_counts:
+                proc = subprocess.run([sys.executable, '-m', 'bench.throughput', '--worker', entry, str(samples), '--workdir', workdir, *worker_args], capture_output=True, text=True)
+                if proc.returncode != 0:
+                    results.append({ 'entry': entry, 'samples': samples, 'error': (proc.stderr.strip().splitlines() or ['exit code %d' % proc.returncode])[-1] })
+                else:
+                    results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+                print_result(results[-1])
+    return results
+
+def print_result(r):
+    if 'error' in r:
+        print(f"{r['entry']:<16} {r['samples']:>7} ERROR {r['error']}")
+        return
+    print(f"{r['entry']:<16} {r['samples']:>7} {r['samples_per_s']:9.1f} samples/s  {r['completed']:>7} done in {r['elapsed_s']:.1f}s  "
+          f"first after {r['first_result_s'] or 0:.1f}s  db {r['db_bytes']/1024/1024:.1f}MB  rss {r['peak_rss_mb']:.0f}MB")
+    for step, s in r['steps'].items():
+        latency = f"p50 {s['p50_s']*1000:.1f}ms p99 {s['p99_s']*1000:.1f}ms" if 'p50_s' in s else ''
+        print(f"    {step:<14} {latency:<28} {s['outcomes']}")
+
+def compare(results, baseline, tolerance):
+    previous = { (r['entry'], r['samples']): r for r in baseline }
+    regressions = []
+    for r in results:
+        old = previous.get((r['entry'], r['samples']))
+        if old is None or 'error' in old: continue
+        if 'error' in r:
+            regressions.append(f"{r['entry']} {r['samples']}: {r['error']}")
+            continue
+        if r['samples_per_s'] < old['samples_per_s'] * (1 - tolerance):
+            regressions.append(f"{r['entry']} {r['samples']}: {old['samples_per_s']:.1f} -> {r['samples_per_s']:.1f} samples/s")
+        if r['peak_rss_mb'] > old['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{r['entry']} {r['samples']}: peak rss {old['peak_rss_mb']:.0f}MB -> {r['peak_rss_mb']:.0f}MB")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scribe throughput benchmark")
+    parser.add_argument("--entry", action="append", help="Entry point module(s) to run, default all")
+    parser.add_argument("--samples", type=int, nargs="+", default=SAMPLES, help="Sample counts to run each entry point at")
+    parser.add_argument("--parallel", type=int, default=64, help="parallel= for LLM and image steps")
+    parser.add_argument("--executor", type=str, default="thread", help="executor= for LLM and image steps (thread or async)")
+    parser.add_argument("--schedule", type=str, default="depth", help="Scheduling policy (depth or breadth)")
+    parser.add_argument("--storage", type=str, default="sqlite", help="Storage backend (sqlite, log or memory)")
+    parser.add_argument("--output", type=str, help="Write results as JSON to this file")
+    parser.add_argument("--baseline", type=str, help="Compare against a previous --output file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression vs baseline")
+    parser.add_argument("--worker", nargs=2, metavar=("ENTRY", "SAMPLES"), help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", type=str, help=argparse.SUPPRESS)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_case(args.worker[0], int(args.worker[1]), args, args.workdir)))
+        sys.exit(0)
+
+    worker_args = ['--parallel', str(args.parallel), '--executor', args.executor, '--schedule', args.schedule, '--storage', args.storage, '--latency', str(args.latency), '--token-rate', str(args.token_rate),
+                   '--tokens', str(args.tokens), '--error-rate', str(args.error_rate), '--error-status', str(args.error_status), '--capacity', str(args.capacity)]
+    if args.image_latency is not None: worker_args += ['--image-latency', str(args.image_latency)]
+
+    results = run_benchmark(args.entry or ENTRY_POINTS, args.samples, worker_args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions: print('REGRESSION:', line)
+        if regressions: sys.exit(1)
@@ -1,6 +1,8 @@
 import random
 from language_tools import get_random_words
 from base import SQLiteScribe
+from storage import SCRIBES
+from endpoint_pool import register_pool
 from steps import *
 
 IDEAS_TEMPLATE = """You are tasked with brainstorming a list of programming challenge tasks suitable for senior-level developers. These challenges should be complex, requiring advanced knowledge and skills in various areas of computer science and software engineering.
@@ -99,7 +101,8 @@ PIPELINE = [
   StepJSONParser(step='Parse', inkey='idea', outkey='challenges'),
   StepExpandTemplate(step='TaskPrompt', inkey='challenges', outkey='task_prompt', template=GENERATE_TASK),
   StepLLMCompletion(step='GenTask', inkey='task_prompt', outkey='task'),
-  StepJSONExport(step='Export', inkey='task')
+  StepJSONExport(step='Export', inkey='task'),
+  StepBulkExport(step='BulkExport', inkey='task', keys='vars,challenges,task', meta='idea,task')
 ]
 
 if __name__ == "__main__":
@@ -109,12 +112,21 @@ if __name__ == "__main__":
     parser.add_argument("--watch", action="store_true", help="Watch mode")
     parser.add_argument("--project", type=str, required=True, help="Project name")
     parser.add_argument("--step", action="append", nargs="+", help="Steps to run")
+    parser.add_argument("--cache", nargs="?", const="", default=None, help="Reuse outputs of deterministic steps from a shared cache (optional path)")
+    parser.add_argument("--pool", action="append", help="Endpoint pool as name=[least:|wrr:]url[*weight],url,... (steps select it with pool=name)")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Serve live metrics on this port (/metrics and /metrics.json)")
+    parser.add_argument("--storage", choices=list(SCRIBES.keys()), default="sqlite", help="Storage backend: sqlite ({project}.db), log (append-only segments in {project}.log/, single process) or memory (flushed to {project}.db every SCRIBE_FLUSH_INTERVAL seconds and at shutdown)")
+    parser.add_argument("--schedule", choices=["depth", "breadth"], default="depth", help="depth: finish samples before generating more (generators wait at watermark=), breadth: fill every step in order")
     args = parser.parse_args()
 
     if not args.step: raise Exception("At least one --step is required.")
 
     try:
-      scr = SQLiteScribe(args.project)
+      scr = SCRIBES[args.storage](args.project)
+      for pool in args.pool or []: register_pool(*pool.split('=', 1))
+      if args.cache is not None: scr.enable_cache(args.cache or None)
+      if args.metrics_port is not None: scr.serve_metrics(args.metrics_port)
+      scr.schedule = args.schedule
       scr.init_pipeline(args.step, PIPELINE)       
       scr.run_all_steps()
     finally:
@@ -0,0 +1,96 @@
+from metrics import METRICS
+import threading
+import time
+import math
+
+class ConcurrencyLimiter():
+    # Adjusts a step's in-flight limit between min_limit and max_limit from observed job latency and errors.
+    # The scheduler reads `limit` as the step's queue capacity; workers report every finished job to on_sample().
+    def __init__(self, name, initial, min_limit, max_limit):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.value = float(max(min_limit, min(max_limit, initial)))
+        self.inflight = 0
+        self.lock = threading.Lock()
+        self.reported = int(self.value)
+        METRICS.set('scribe_concurrency_limit', self.limit, step=self.name)
+
+    @property
+    def limit(self):
+        return int(self.value)
+
+    def started(self):
+        with self.lock:
+            self.inflight += 1
+
+    def finished(self):
+        with self.lock:
+            self.inflight -= 1
+
+    def on_sample(self, latency, ok):
+        with self.lock:
+            self.value = float(max(self.min_limit, min(self.max_limit, self._update(latency, ok))))
+            limit = self.limit
+            # log when the limit has moved by a quarter since the last report, every step change would flood the output
+            if abs(limit - self.reported) >= max(1, self.reported // 4):
+                print(f"{self.name} concurrency limit {self.reported} -> {limit}")
+                self.reported = limit
+        METRICS.set('scribe_concurrency_limit', limit, step=self.name)
+
+    def _update(self, latency, ok):
+        raise Exception('_update() must be implemented.')
+
+class AIMDLimiter(ConcurrencyLimiter):
+    # Additive increase (about +1 per limit's worth of successes while the limit is actually used), multiplicative
+    # decrease on errors or when latency exceeds latency_max. Decreases are spaced by one smoothed latency so a burst
+    # of failures from the same overloaded moment only backs off once.
+    def __init__(self, name, initial, min_limit, max_limit, backoff = 0.75, latency_max = None):
+        super().__init__(name, initial, min_limit, max_limit)
+        self.backoff = backoff
+        self.latency_max = latency_max
+        self.latency = None
+        self.last_decrease = 0.0
+
+    def _update(self, latency, ok):
+        self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+        overloaded = not ok or (self.latency_max is not None and latency > self.latency_max)
+        if overloaded:
+            if time.time() - self.last_decrease < self.latency: return self.value
+            self.last_decrease = time.time()
+            return self.value * self.backoff
+        if self.inflight >= self.limit * 0.8: return self.value + 1.0 / self.value
+        return self.value
+
+class GradientLimiter(ConcurrencyLimiter):
+    # Gradient control: compares a no-load latency baseline to the recent latency. While they agree the limit
+    # grows by sqrt(limit) headroom; when recent latency rises more than `tolerance` above the baseline (queueing
+    # at the server) the limit shrinks in proportion. Errors count as a sample at twice the baseline.
+    def __init__(self, name, initial, min_limit, max_limit, smoothing = 0.2, window = 10, tolerance = 1.5):
+        super().__init__(name, initial, min_limit, max_limit)
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.window = window
+        self.samples = []
+        self.baseline = None
+
+    def _update(self, latency, ok):
+        if not ok and self.baseline is not None: latency = 2 * self.baseline
+        self.samples.append(latency)
+        if len(self.samples) < self.window: return self.value
+        recent = sum(self.samples) / len(self.samples)
+        self.samples = []
+        # the baseline is the lowest recent latency seen, allowed to creep up slowly so a change of model or prompt
+        # length is picked up eventually; an averaged baseline would follow the queueing it is meant to detect
+        self.baseline = recent if self.baseline is None else min(recent, self.baseline * 1.002)
+        gradient = max(0.5, min(1.0, self.tolerance * self.baseline / recent))
+        # only grow with sqrt(limit) headroom while the current limit is actually being used
+        headroom = math.sqrt(self.value) if self.inflight >= self.limit * 0.8 else 0.0
+        target = self.value * gradient + headroom
+        return (1 - self.smoothing) * self.value + self.smoothing * target
+
+LIMITERS = { 'aimd': AIMDLimiter, 'gradient': GradientLimiter }
+
+def build_limiter(name, kind, initial, min_limit, max_limit, **kwargs):
+    if kind not in LIMITERS: raise Exception(f'Unknown limiter {kind}, should be one of: {", ".join(LIMITERS.keys())}')
+    return LIMITERS[kind](name, initial, min_limit, max_limit, **kwargs)
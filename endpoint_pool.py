@@ -0,0 +1,137 @@
+from metrics import METRICS
+import threading
+import time
+import os
+
+POLICIES = ('least', 'wrr')
+
+class Endpoint():
+    def __init__(self, url, weight = 1.0):
+        self.url = url.rstrip('/')
+        self.weight = weight
+        self.outstanding = 0
+        self.current_weight = 0.0
+        self.last_used = 0
+        self.outcomes = []
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.probing = False
+
+    def available(self, now):
+        return self.ejected_until <= now and not self.probing
+
+    def __repr__(self):
+        return f'Endpoint({self.url}, weight={self.weight}, outstanding={self.outstanding})'
+
+class EndpointPool():
+    # Routes requests across interchangeable backends serving the same model. 'least' picks the endpoint with the
+    # fewest outstanding requests relative to its weight, 'wrr' is smooth weighted round robin. Endpoints are ejected
+    # after consecutive failures or a high error rate over the recent window, then re-admitted by a single probe
+    # request once their ejection (doubling per repeat offence) expires.
+    def __init__(self, endpoints, policy = 'least', window = 20, max_error_rate = 0.5, max_failures = 3, eject_base = 5.0, eject_max = 120.0):
+        if len(endpoints) == 0: raise Exception('EndpointPool requires at least one endpoint')
+        if policy not in POLICIES: raise Exception(f'Unknown pool policy {policy}, should be one of: {", ".join(POLICIES)}')
+        self.endpoints = endpoints
+        self.policy = policy
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.max_failures = max_failures
+        self.eject_base = eject_base
+        self.eject_max = eject_max
+        self.lock = threading.Lock()
+        self.sequence = 0
+
+    @classmethod
+    def parse(cls, spec):
+        # "[policy:]url[*weight],url[*weight],..."
+        policy = 'least'
+        head, _, rest = spec.partition(':')
+        if head in POLICIES: policy, spec = head, rest
+        endpoints = []
+        for part in spec.split(','):
+            if not part.strip(): continue
+            url, _, weight = part.strip().partition('*')
+            endpoints.append(Endpoint(url, float(weight) if weight else 1.0))
+        return cls(endpoints, policy)
+
+    def _pick(self, now):
+        candidates = [e for e in self.endpoints if e.available(now)]
+        if len(candidates) == 0:
+            # everything is ejected: fall back to whichever comes back first rather than failing the request
+            return min(self.endpoints, key=lambda e: e.ejected_until)
+        if self.policy == 'least':
+            # ties go to the least recently used endpoint, so light sequential traffic still spreads
+            return min(candidates, key=lambda e: ((e.outstanding + 1) / e.weight, e.last_used))
+        total = sum(e.weight for e in candidates)
+        for e in candidates: e.current_weight += e.weight
+        best = max(candidates, key=lambda e: e.current_weight)
+        best.current_weight -= total
+        return best
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            endpoint = self._pick(now)
+            # an endpoint whose ejection just expired gets exactly one request through before full re-admission
+            if endpoint.ejections > 0 and endpoint.ejected_until <= now and endpoint.failures > 0: endpoint.probing = True
+            endpoint.outstanding += 1
+            self.sequence += 1
+            endpoint.last_used = self.sequence
+            METRICS.set('scribe_endpoint_outstanding', endpoint.outstanding, endpoint=endpoint.url)
+            return endpoint
+
+    def release(self, endpoint, ok):
+        with self.lock:
+            endpoint.outstanding -= 1
+            endpoint.outcomes = (endpoint.outcomes + [ok])[-self.window:]
+            endpoint.failures = 0 if ok else endpoint.failures + 1
+            was_probing, endpoint.probing = endpoint.probing, False
+            error_rate = endpoint.outcomes.count(False) / len(endpoint.outcomes)
+            # requests already in flight when the endpoint was ejected must not extend the ejection
+            already_ejected = endpoint.ejected_until > time.time()
+            if not ok and not already_ejected and (was_probing or endpoint.failures >= self.max_failures or (len(endpoint.outcomes) >= self.window // 2 and error_rate > self.max_error_rate)):
+                self._eject(endpoint, 'probe failed' if was_probing else f'{endpoint.failures} consecutive failures, error rate {error_rate:.0%}')
+            elif ok and was_probing:
+                print(f"Endpoint {endpoint.url} re-admitted")
+                endpoint.ejections = 0
+                endpoint.outcomes = []
+                METRICS.set('scribe_endpoint_ejected', 0, endpoint=endpoint.url)
+            METRICS.set('scribe_endpoint_outstanding', endpoint.outstanding, endpoint=endpoint.url)
+
+    def _eject(self, endpoint, reason):
+        duration = min(self.eject_max, self.eject_base * (2 ** endpoint.ejections))
+        endpoint.ejections += 1
+        endpoint.ejected_until = time.time() + duration
+        endpoint.outcomes = []
+        print(f"WARNING: endpoint {endpoint.url} ejected for {duration:.0f}s ({reason})")
+        METRICS.set('scribe_endpoint_ejected', 1, endpoint=endpoint.url)
+        METRICS.inc('scribe_endpoint_ejections_total', endpoint=endpoint.url)
+
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            return [{ 'url': e.url, 'weight': e.weight, 'outstanding': e.outstanding, 'ejected': not e.available(now) and not e.probing } for e in self.endpoints]
+
+DEFAULT_POOLS = {
+    'llm': lambda: os.getenv('OPENAI_BASE_URL', "http://100.109.96.89:3333/v1"),
+    'image': lambda: os.getenv('IMAGE_API_URL', 'http://127.0.0.1:5001')
+}
+
+endpoint_pools = {}
+endpoint_pools_lock = threading.Lock()
+
+def register_pool(name, spec):
+    with endpoint_pools_lock:
+        endpoint_pools[name] = EndpointPool.parse(spec)
+        return endpoint_pools[name]
+
+def get_pool(name):
+    # pools come from register_pool (--pool name=spec), SCRIBE_POOL_<NAME>, or the OPENAI_BASE_URL / IMAGE_API_URL defaults
+    with endpoint_pools_lock:
+        if name not in endpoint_pools:
+            spec = os.getenv(f'SCRIBE_POOL_{name.upper()}')
+            if spec is None and name in DEFAULT_POOLS: spec = DEFAULT_POOLS[name]()
+            if spec is None: raise Exception(f'Endpoint pool {name} is not defined, use --pool {name}=url,url or SCRIBE_POOL_{name.upper()}')
+            endpoint_pools[name] = EndpointPool.parse(spec)
+        return endpoint_pools[name]
@@ -0,0 +1,107 @@
+import threading
+import gzip
+import json
+import os
+import re
+
+FORMATS = ('jsonl', 'jsonl.gz', 'jsonl.zst', 'parquet')
+
+class ShardWriter():
+    # Streams rows (dicts with the same columns) into numbered shards {prefix}-{pid}-{n:05d}.{format} of at most
+    # shard_rows rows. A shard is written under a .tmp name and renamed once complete, so a reader never picks
+    # up a partial file. The pid keeps workers exporting into the same directory from ever picking the same name;
+    # numbering continues after the shards this pid already has in the directory. Leftover .tmp shards of a
+    # process that is gone are deleted and listed (by their final name) in abandoned; other live workers' are left alone.
+    def __init__(self, directory, prefix, columns, format = 'jsonl', shard_rows = 100000):
+        if format not in FORMATS: raise Exception(f'Unknown export format {format}, should be one of: {", ".join(FORMATS)}')
+        # zstandard and pyarrow are only imported for the format that needs them, pyarrow alone costs seconds at startup
+        try:
+            if format == 'jsonl.zst': import zstandard
+            if format == 'parquet': import pyarrow.parquet
+        except ImportError:
+            raise Exception(f'Export format {format} requires the {"zstandard" if format == "jsonl.zst" else "pyarrow"} package')
+        self.directory = directory
+        self.prefix = prefix
+        self.columns = columns
+        self.format = format
+        self.shard_rows = shard_rows
+        self.lock = threading.Lock()
+        self.file = None
+        self.rows_in_shard = 0
+        self.shards = []
+
+        self.owner = os.getpid()
+
+        os.makedirs(directory, exist_ok=True)
+        pattern = re.compile(rf'{re.escape(prefix)}-(\d+)-(\d+)\.{re.escape(format)}$')
+        existing = [int(m.group(2)) for m in map(pattern.match, os.listdir(directory)) if m and int(m.group(1)) == self.owner]
+        self.next_shard = max(existing, default=-1) + 1
+        leftover = [(name[:-4], m) for name in os.listdir(directory) if name.endswith('.tmp') for m in [pattern.match(name[:-4])] if m]
+        self.abandoned = [os.path.join(directory, name) for name, m in leftover if not self._alive(int(m.group(1)))]
+        for path in self.abandoned: os.remove(path + '.tmp')
+
+    def _alive(self, pid):
+        # a .tmp under this process' own pid was left by an earlier process that had the same pid
+        if pid == self.owner: return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _open(self):
+        self.path = os.path.join(self.directory, f'{self.prefix}-{self.owner}-{self.next_shard:05d}.{self.format}')
+        self.next_shard += 1
+        tmp = self.path + '.tmp'
+        if self.format == 'jsonl':
+            self.file = open(tmp, 'w')
+        elif self.format == 'jsonl.gz':
+            self.file = gzip.open(tmp, 'wt', compresslevel=6)
+        elif self.format == 'jsonl.zst':
+            import zstandard
+            self.raw = open(tmp, 'wb')
+            self.file = zstandard.ZstdCompressor().stream_writer(self.raw)
+        else:
+            import pyarrow, pyarrow.parquet
+            # parquet cells hold strings: payloads are free-form JSON, so one inferred schema would not fit every row
+            schema = pyarrow.schema([(column, pyarrow.string()) for column in self.columns])
+            self.file = pyarrow.parquet.ParquetWriter(tmp, schema, compression='zstd')
+        self.rows_in_shard = 0
+
+    def _write(self, rows):
+        if self.format == 'parquet':
+            import pyarrow
+            cells = { column: [row.get(column) if isinstance(row.get(column), (str, type(None))) else json.dumps(row.get(column)) for row in rows] for column in self.columns }
+            self.file.write_table(pyarrow.table(cells, schema=self.file.schema))
+        elif self.format == 'jsonl.zst':
+            self.file.write(''.join(json.dumps(row) + '\n' for row in rows).encode())
+        else:
+            self.file.write(''.join(json.dumps(row) + '\n' for row in rows))
+        self.rows_in_shard += len(rows)
+
+    def _close_shard(self):
+        self.file.close()
+        if self.format == 'jsonl.zst': self.raw.close()
+        os.replace(self.path + '.tmp', self.path)
+        self.shards.append(self.path)
+        print(f"Exported {self.rows_in_shard} rows to {self.path}")
+        self.file = None
+
+    def write(self, rows):
+        # returns the shard each row went to
+        shards = []
+        with self.lock:
+            while len(rows) > 0:
+                if self.file is None: self._open()
+                room = self.shard_rows - self.rows_in_shard
+                self._write(rows[:room])
+                shards += [self.path] * len(rows[:room])
+                rows = rows[room:]
+                if self.rows_in_shard >= self.shard_rows: self._close_shard()
+        return shards
+
+    def close(self):
+        with self.lock:
+            if self.file is not None: self._close_shard()
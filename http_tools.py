@@ -0,0 +1,260 @@
+import requests
+from requests.adapters import HTTPAdapter
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from metrics import METRICS
+import threading
+import asyncio
+import random
+import time
+import json
+import os
+
+HTTP_CONFIG = {
+    'connect_timeout': float(os.getenv('SCRIBE_HTTP_CONNECT_TIMEOUT', '10')),
+    'read_timeout': float(os.getenv('SCRIBE_HTTP_READ_TIMEOUT', '600')),
+    'max_retries': int(os.getenv('SCRIBE_HTTP_MAX_RETRIES', '5')),
+    'backoff_base': float(os.getenv('SCRIBE_HTTP_BACKOFF_BASE', '0.5')),
+    'backoff_max': float(os.getenv('SCRIBE_HTTP_BACKOFF_MAX', '60')),
+    'pool_size': int(os.getenv('SCRIBE_HTTP_POOL_SIZE', '256')),
+    'max_response_bytes': int(os.getenv('SCRIBE_HTTP_MAX_RESPONSE_BYTES', str(256*1024*1024)))
+}
+
+RETRY_STATUS = (429, 502, 503, 504)
+
+class ResponseTooLarge(Exception):
+    pass
+
+def configure_http(**kwargs):
+    for k, v in kwargs.items():
+        if k not in HTTP_CONFIG: raise Exception(f'Unknown http option {k}, should be one of: {", ".join(HTTP_CONFIG.keys())}')
+        HTTP_CONFIG[k] = type(HTTP_CONFIG[k])(v)
+    # pools are sized from the config, rebuild them on next use
+    global _session
+    _session = None
+    _async_sessions.clear()
+
+def retry_delay(attempt, retry_after = None):
+    # Retry-After wins when the server sends one (seconds or an HTTP date), otherwise full-jitter exponential backoff.
+    if retry_after:
+        try:
+            return min(HTTP_CONFIG['backoff_max'], max(0.0, float(retry_after)))
+        except ValueError:
+            try:
+                return min(HTTP_CONFIG['backoff_max'], max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()))
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(HTTP_CONFIG['backoff_max'], HTTP_CONFIG['backoff_base'] * (2 ** attempt)))
+
+def _record(url, status, started):
+    # one sample per attempt, so retries and failed connections show up in the backend rates
+    endpoint = urlsplit(url).netloc
+    METRICS.inc('scribe_backend_requests_total', endpoint=endpoint, status=str(status))
+    METRICS.observe('scribe_backend_request_seconds', time.time() - started, endpoint=endpoint)
+
+def _route(url, pool):
+    if pool is None: return None, url
+    endpoint = pool.acquire()
+    return endpoint, endpoint.url + url
+
+def _release(pool, endpoint, status):
+    # 5xx, 429 and transport errors (status None) count against the endpoint's health, other answers are its client's problem
+    if endpoint is not None: pool.release(endpoint, status is not None and status < 500 and status != 429)
+
+def _decode(status, body):
+    if status != 200: return None
+    return json.loads(body) if body else None
+
+_session = None
+_session_lock = threading.Lock()
+
+def http_session():
+    # One process-wide keep-alive session; urllib3 keeps a separate pool per host, each up to pool_size connections.
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=HTTP_CONFIG['pool_size'])
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+def _read_limited(response):
+    length = response.headers.get('Content-Length')
+    if length is not None and int(length) > HTTP_CONFIG['max_response_bytes']:
+        raise ResponseTooLarge(f'{response.url} response is {length} bytes')
+    body = bytearray()
+    for chunk in response.iter_content(chunk_size=65536):
+        body += chunk
+        if len(body) > HTTP_CONFIG['max_response_bytes']:
+            raise ResponseTooLarge(f'{response.url} response exceeds {HTTP_CONFIG["max_response_bytes"]} bytes')
+    return bytes(body)
+
+# POST a JSON payload with pooling, timeouts and retries. Returns (status_code, decoded json or None).
+# With an EndpointPool, url is a path and every attempt (retries included) is routed to an endpoint of the pool.
+def post_json(url, payload, headers = None, pool = None):
+    timeout = (HTTP_CONFIG['connect_timeout'], HTTP_CONFIG['read_timeout'])
+    for attempt in range(HTTP_CONFIG['max_retries'] + 1):
+        last_attempt = attempt == HTTP_CONFIG['max_retries']
+        endpoint, target = _route(url, pool)
+        started = time.time()
+        status = None
+        try:
+            with http_session().post(target, json=payload, headers=headers, timeout=timeout, stream=True) as response:
+                code = response.status_code
+                _record(target, code, started)
+                if code in RETRY_STATUS and not last_attempt:
+                    status = code
+                    delay = retry_delay(attempt, response.headers.get('Retry-After'))
+                    print(f"WARNING: {target} returned {code}, retry {attempt+1} in {delay:.1f}s")
+                    time.sleep(delay)
+                    continue
+                decoded = _decode(code, _read_limited(response))
+                # only a body read and decoded in full counts as a healthy response
+                status = code
+                return status, decoded
+        except (requests.ConnectionError, requests.Timeout) as e:
+            _record(target, type(e).__name__, started)
+            if last_attempt: raise
+            delay = retry_delay(attempt)
+            print(f"WARNING: {target} failed with {type(e).__name__}, retry {attempt+1} in {delay:.1f}s")
+            time.sleep(delay)
+        finally:
+            _release(pool, endpoint, status)
+
+# Streaming POST: retries like post_json until the server answers 200, then yields decoded body lines as they arrive.
+def post_stream(url, payload, headers = None, pool = None):
+    timeout = (HTTP_CONFIG['connect_timeout'], HTTP_CONFIG['read_timeout'])
+    for attempt in range(HTTP_CONFIG['max_retries'] + 1):
+        last_attempt = attempt == HTTP_CONFIG['max_retries']
+        endpoint, target = _route(url, pool)
+        started = time.time()
+        status = None
+        try:
+            try:
+                response = http_session().post(target, json=payload, headers=headers, timeout=timeout, stream=True)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                _record(target, type(e).__name__, started)
+                if last_attempt: raise
+                delay = retry_delay(attempt)
+                print(f"WARNING: {target} failed with {type(e).__name__}, retry {attempt+1} in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            _record(target, response.status_code, started)
+            with response:
+                if response.status_code in RETRY_STATUS and not last_attempt:
+                    status = response.status_code
+                    delay = retry_delay(attempt, response.headers.get('Retry-After'))
+                    print(f"WARNING: {target} returned {status}, retry {attempt+1} in {delay:.1f}s")
+                    time.sleep(delay)
+                    continue
+                if response.status_code != 200:
+                    status = response.status_code
+                    raise Exception(f"{target} failed with status code {status}")
+                # chunk_size=None hands over bytes as soon as they arrive, iter_lines() would buffer and skew first-token timing
+                received = 0
+                buffer = b''
+                for data in response.iter_content(chunk_size=None):
+                    received += len(data)
+                    if received > HTTP_CONFIG['max_response_bytes']: raise ResponseTooLarge(f'{target} response exceeds {HTTP_CONFIG["max_response_bytes"]} bytes')
+                    *lines, buffer = (buffer + data).split(b'\n')
+                    for line in lines: yield line.rstrip(b'\r').decode('utf-8')
+                if buffer: yield buffer.rstrip(b'\r').decode('utf-8')
+                # only a stream read to the end counts as a healthy response
+                status = 200
+                return
+        finally:
+            _release(pool, endpoint, status)
+
+_async_sessions = {}
+
+def async_http_session():
+    # one aiohttp session (and connection pool) per event loop, aiohttp is only needed by async steps
+    import aiohttp
+    loop = asyncio.get_running_loop()
+    if loop not in _async_sessions:
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=HTTP_CONFIG['pool_size'])
+        timeout = aiohttp.ClientTimeout(sock_connect=HTTP_CONFIG['connect_timeout'], sock_read=HTTP_CONFIG['read_timeout'])
+        _async_sessions[loop] = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _async_sessions[loop]
+
+async def _read_limited_async(response):
+    if response.content_length is not None and response.content_length > HTTP_CONFIG['max_response_bytes']:
+        raise ResponseTooLarge(f'{response.url} response is {response.content_length} bytes')
+    body = bytearray()
+    async for chunk in response.content.iter_chunked(65536):
+        body += chunk
+        if len(body) > HTTP_CONFIG['max_response_bytes']:
+            raise ResponseTooLarge(f'{response.url} response exceeds {HTTP_CONFIG["max_response_bytes"]} bytes')
+    return bytes(body)
+
+# Coroutine version of post_json with the same retry policy.
+async def async_post_json(url, payload, headers = None, pool = None):
+    import aiohttp
+    for attempt in range(HTTP_CONFIG['max_retries'] + 1):
+        last_attempt = attempt == HTTP_CONFIG['max_retries']
+        endpoint, target = _route(url, pool)
+        started = time.time()
+        status = None
+        try:
+            async with async_http_session().post(target, json=payload, headers=headers) as response:
+                code = response.status
+                _record(target, code, started)
+                if code in RETRY_STATUS and not last_attempt:
+                    status = code
+                    delay = retry_delay(attempt, response.headers.get('Retry-After'))
+                    print(f"WARNING: {target} returned {code}, retry {attempt+1} in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    continue
+                decoded = _decode(code, await _read_limited_async(response))
+                # only a body read and decoded in full counts as a healthy response
+                status = code
+                return status, decoded
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            _record(target, type(e).__name__, started)
+            if last_attempt: raise
+            delay = retry_delay(attempt)
+            print(f"WARNING: {target} failed with {type(e).__name__}, retry {attempt+1} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        finally:
+            _release(pool, endpoint, status)
+
+# Coroutine version of post_stream, an async generator of decoded body lines.
+async def async_post_stream(url, payload, headers = None, pool = None):
+    import aiohttp
+    for attempt in range(HTTP_CONFIG['max_retries'] + 1):
+        last_attempt = attempt == HTTP_CONFIG['max_retries']
+        endpoint, target = _route(url, pool)
+        started = time.time()
+        status = None
+        try:
+            try:
+                response = await async_http_session().post(target, json=payload, headers=headers)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                _record(target, type(e).__name__, started)
+                if last_attempt: raise
+                delay = retry_delay(attempt)
+                print(f"WARNING: {target} failed with {type(e).__name__}, retry {attempt+1} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            _record(target, response.status, started)
+            async with response:
+                if response.status in RETRY_STATUS and not last_attempt:
+                    status = response.status
+                    delay = retry_delay(attempt, response.headers.get('Retry-After'))
+                    print(f"WARNING: {target} returned {status}, retry {attempt+1} in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    continue
+                if response.status != 200:
+                    status = response.status
+                    raise Exception(f"{target} failed with status code {status}")
+                received = 0
+                async for line in response.content:
+                    received += len(line)
+                    if received > HTTP_CONFIG['max_response_bytes']: raise ResponseTooLarge(f'{target} response exceeds {HTTP_CONFIG["max_response_bytes"]} bytes')
+                    yield line.decode('utf-8').rstrip('\r\n')
+                status = 200
+                return
+        finally:
+            _release(pool, endpoint, status)
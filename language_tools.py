@@ -1,5 +1,6 @@
 import os
 import random
+import threading
 
 def create_dictionaries():
     import nltk
@@ -21,13 +22,20 @@ def create_dictionaries():
             f.write(f"{word}\n")
 
 word_lists = {}
-if not os.path.isfile('basic.txt'): create_dictionaries()
+word_lists_lock = threading.Lock()
+
+def load_word_lists():
+    # Read (or build with NLTK) the word lists on first use instead of at import time.
+    with word_lists_lock:
+        if len(word_lists) == 0:
+            if not os.path.isfile('basic.txt'): create_dictionaries()
   
-with open('basic.txt', 'r') as f:
-    word_lists['basic'] = f.read().splitlines()
+            with open('basic.txt', 'r') as f:
+                word_lists['basic'] = f.read().splitlines()
             
-with open('advanced.txt', 'r') as f:
-    word_lists['advanced'] = f.read().splitlines()
+            with open('advanced.txt', 'r') as f:
+                word_lists['advanced'] = f.read().splitlines()
+    return word_lists
             
 def get_random_words(list_name, num_words):
-    return random.sample(word_lists[list_name], num_words)
\ No newline at end of file
+    return random.sample(load_word_lists()[list_name], num_words)
\ No newline at end of file
@@ -1,21 +1,23 @@
-from transformers import AutoTokenizer
-import requests
+from http_tools import post_json, async_post_json, post_stream, async_post_stream
+from endpoint_pool import get_pool
+from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+import time
 import os
 import json
 
-API_BASE_URL = os.getenv('OPENAI_BASE_URL',"http://100.109.96.89:3333/v1")
 API_KEY = os.getenv('OPENAI_API_KEY', "xx-ignored")
 
-def universal_llm_request(completion, model, messages, params, n):
+# Requests go to an endpoint pool (see endpoint_pool.py), 'llm' is built from OPENAI_BASE_URL. Paths are relative to the pool.
+def _llm_request_payload(completion, model, messages, params, n):
         payload = { 'model': model, 'n': n, 'messages': messages, **params }
-        headers = { 'Authentication': 'Bearer '+API_KEY }
-    
         if completion:
-            payload['prompt'] = payload.pop('messages')[0]['content']            
-            response = requests.post(API_BASE_URL+'/completions', json=payload, headers=headers).json()                     
-        else:
-            response = requests.post(API_BASE_URL+'/chat/completions', json=payload, headers=headers).json()
-        
+            payload['prompt'] = payload.pop('messages')[0]['content']
+            return '/completions', payload
+        return '/chat/completions', payload
+
+def _llm_response_answers(response):
         if 'choices' in response:
             # OpenAI-style response
             answers = [x['message']['content'] if 'message' in x else x['text'] for x in response['choices']]
@@ -28,6 +30,168 @@ def universal_llm_request(completion, model, messages, params, n):
             
         return answers
 
+def universal_llm_request(completion, model, messages, params, n, pool = 'llm'):
+        url, payload = _llm_request_payload(completion, model, messages, params, n)
+        headers = { 'Authentication': 'Bearer '+API_KEY }
+        status, response = post_json(url, payload, headers, pool=get_pool(pool))
+        if response is None: raise Exception(f"LLM request to {url} (pool {pool}) failed with status code {status}")
+        return _llm_response_answers(response)
+
+async def universal_llm_request_async(completion, model, messages, params, n, pool = 'llm'):
+        url, payload = _llm_request_payload(completion, model, messages, params, n)
+        headers = { 'Authentication': 'Bearer '+API_KEY }
+        status, response = await async_post_json(url, payload, headers, pool=get_pool(pool))
+        if response is None: raise Exception(f"LLM request to {url} (pool {pool}) failed with status code {status}")
+        return _llm_response_answers(response)
+
+class StreamStats:
+    # Accumulates SSE chunks (OpenAI chat/completion deltas or llama-server legacy chunks) into answers,
+    # timing the first token and reading usage from the final chunk when the server sends it.
+    def __init__(self):
+        self.start = time.time()
+        self.first_token = None
+        self.texts = {}
+        self.chunks = 0
+        self.usage = None
+
+    def feed(self, line):
+        if not line.startswith('data:'): return
+        data = line[5:].strip()
+        if data == '[DONE]' or data == '': return
+        chunk = json.loads(data)
+        if chunk.get('usage'): self.usage = chunk['usage']
+        if 'choices' in chunk:
+            pieces = [(x.get('index', 0), x['delta'].get('content') if 'delta' in x else x.get('text')) for x in chunk['choices']]
+        else:
+            pieces = [(0, chunk.get('content'))]
+            if 'tokens_predicted' in chunk: self.usage = { 'prompt_tokens': chunk.get('tokens_evaluated'), 'completion_tokens': chunk['tokens_predicted'] }
+        for index, text in pieces:
+            if not text: continue
+            if self.first_token is None: self.first_token = time.time()
+            self.texts[index] = self.texts.get(index, '') + text
+            self.chunks += 1
+
+    def answers(self):
+        return [self.texts[i] for i in sorted(self.texts.keys())]
+
+    def stats(self):
+        end = time.time()
+        usage = self.usage or { 'completion_tokens': self.chunks, 'estimated': True }
+        ttft = (self.first_token - self.start) if self.first_token else None
+        decode_time = (end - self.first_token) if self.first_token else None
+        completion_tokens = usage.get('completion_tokens') or 0
+        return {
+            'ttft': ttft,
+            'latency': end - self.start,
+            'decode_tps': completion_tokens / decode_time if decode_time else None,
+            'usage': usage
+        }
+
+def _llm_stream_payload(completion, model, messages, params, n):
+        url, payload = _llm_request_payload(completion, model, messages, params, n)
+        payload['stream'] = True
+        payload['stream_options'] = { 'include_usage': True }
+        return url, payload
+
+def universal_llm_request_stream(completion, model, messages, params, n, pool = 'llm'):
+        url, payload = _llm_stream_payload(completion, model, messages, params, n)
+        headers = { 'Authentication': 'Bearer '+API_KEY }
+        stream = StreamStats()
+        for line in post_stream(url, payload, headers, pool=get_pool(pool)): stream.feed(line)
+        return stream.answers(), stream.stats()
+
+async def universal_llm_request_stream_async(completion, model, messages, params, n, pool = 'llm'):
+        url, payload = _llm_stream_payload(completion, model, messages, params, n)
+        headers = { 'Authentication': 'Bearer '+API_KEY }
+        stream = StreamStats()
+        async for line in async_post_stream(url, payload, headers, pool=get_pool(pool)): stream.feed(line)
+        return stream.answers(), stream.stats()
+
+def _split_batched_answers(response, num_prompts, n):
+        # OpenAI-style: choices for prompt i carry index i*n..i*n+n-1. llama-server answers a prompt list with a list of results.
+        if isinstance(response, list):
+            return [_llm_response_answers(r) for r in response]
+        if 'choices' not in response:
+            print(response)
+            return [None] * num_prompts
+        answers = [[] for _ in range(num_prompts)]
+        for pos, choice in enumerate(sorted(response['choices'], key=lambda x: x.get('index', 0))):
+            idx = choice.get('index', pos) // n
+            if idx < num_prompts: answers[idx].append(choice['text'])
+        return answers
+
+class CompletionBatcher:
+    # Collects single-prompt /completions requests from many workers and sends them as one multi-prompt
+    # request once max_batch prompts are waiting or the oldest has waited max_wait seconds.
+    # Prompts are only grouped with others for the same model, sampler, n and endpoint pool.
+    def __init__(self, max_batch, max_wait):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.cond = threading.Condition()
+        self.waiting = {}
+        self.senders = ThreadPoolExecutor(max_workers=32)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, model, prompt, params, n, pool = 'llm'):
+        future = Future()
+        group = (model, json.dumps(params, sort_keys=True), n, pool)
+        with self.cond:
+            self.waiting.setdefault(group, []).append((prompt, future, time.time()))
+            self.cond.notify()
+        return future
+
+    def _take_ready(self):
+        ready = []
+        now = time.time()
+        for group, items in self.waiting.items():
+            while len(items) >= self.max_batch or (len(items) > 0 and now - items[0][2] >= self.max_wait):
+                ready.append((group, items[:self.max_batch]))
+                del items[:self.max_batch]
+        return ready
+
+    def _next_timeout(self):
+        deadlines = [items[0][2] + self.max_wait for items in self.waiting.values() if len(items) > 0]
+        return max(0, min(deadlines) - time.time()) if deadlines else None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                ready = self._take_ready()
+                while len(ready) == 0:
+                    self.cond.wait(self._next_timeout())
+                    ready = self._take_ready()
+            for group, items in ready:
+                self.senders.submit(self._send, group, items)
+
+    def _send(self, group, items):
+        model, params, n, pool = group
+        url = '/completions'
+        payload = { 'model': model, 'n': n, 'prompt': [prompt for prompt, _, _ in items], **json.loads(params) }
+        headers = { 'Authentication': 'Bearer '+API_KEY }
+        try:
+            status, response = post_json(url, payload, headers, pool=get_pool(pool))
+            if response is None: raise Exception(f"LLM request to {url} (pool {pool}) failed with status code {status}")
+            results = _split_batched_answers(response, len(items), n)
+        except Exception as e:
+            for _, future, _ in items: future.set_exception(e)
+            return
+        # a prompt without answers fails on its own, the rest of the batch still completes
+        for (_, future, _), answers in zip(items, results):
+            if answers: future.set_result(answers)
+            else: future.set_exception(Exception("LLM batch returned no completion for this prompt"))
+        for _, future, _ in items[len(results):]:
+            future.set_exception(Exception("LLM batch returned no completion for this prompt"))
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+def batched_llm_request(model, prompt, params, n, max_batch, max_wait, pool = 'llm'):
+        with _batchers_lock:
+            if (max_batch, max_wait) not in _batchers: _batchers[(max_batch, max_wait)] = CompletionBatcher(max_batch, max_wait)
+            batcher = _batchers[(max_batch, max_wait)]
+        return batcher.submit(model, prompt, params, n, pool)
+
 def simple_extract_json(response, first_key = False):
     result = response[response.find('{'):response.rfind('}')+1]
     try:
@@ -74,10 +238,59 @@ f"""### Instruction:
 ### Response:{assistant}""")
 }
 
+class CompiledChatTemplate:
+    # Wraps a Hugging Face tokenizer with its chat template compiled once up front, so rendering a prompt
+    # is a single jinja render instead of a trip through apply_chat_template.
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.name_or_path = tokenizer.name_or_path
+        self.template = None
+        
+        chat_template = getattr(tokenizer, 'chat_template', None)
+        if isinstance(chat_template, str):
+            from jinja2.sandbox import ImmutableSandboxedEnvironment
+            env = ImmutableSandboxedEnvironment(trim_blocks=True, lstrip_blocks=True, extensions=['jinja2.ext.loopcontrols'])
+            env.globals['raise_exception'] = _raise_template_exception
+            env.globals['strftime_now'] = lambda fmt: datetime.now().strftime(fmt)
+            self.template = env.from_string(chat_template)
+            self.special_tokens = { k: v for k, v in tokenizer.special_tokens_map.items() if isinstance(v, str) }
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True, bos_token=''):
+        if self.template is None or tokenize:
+            return self.tokenizer.apply_chat_template(messages, tokenize=tokenize, add_generation_prompt=add_generation_prompt, bos_token=bos_token)
+        return self.template.render(messages=messages, add_generation_prompt=add_generation_prompt, **{ **self.special_tokens, 'bos_token': bos_token })
+
+def _raise_template_exception(message):
+    raise Exception(f'chat template error: {message}')
+
+class TokenizerRegistry:
+    # Process-wide cache: each tokenizer is loaded once, concurrent first requests for the same name wait on one load.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.name_locks = {}
+        self.tokenizers = dict(tokenizer_internal)
+        self.load_times = {}
+
+    def get(self, tokenizer_name):
+        if tokenizer_name in self.tokenizers: return self.tokenizers[tokenizer_name]
+        with self.lock:
+            name_lock = self.name_locks.setdefault(tokenizer_name, threading.Lock())
+        with name_lock:
+            if tokenizer_name not in self.tokenizers:
+                t0 = time.time()
+                from transformers import AutoTokenizer
+                tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, trust_remote_code=True)
+                self.tokenizers[tokenizer_name] = CompiledChatTemplate(tokenizer)
+                self.load_times[tokenizer_name] = time.time() - t0
+                print(f"Loaded tokenizer {tokenizer_name} in {self.load_times[tokenizer_name]:.2f}s")
+        return self.tokenizers[tokenizer_name]
+
+    def stats(self):
+        return dict(self.load_times)
+
+tokenizer_registry = TokenizerRegistry()
+
 def build_tokenizer(tokenizer_name):
     if tokenizer_name is None:
         return None
-    elif tokenizer_name in tokenizer_internal:
-        return tokenizer_internal[tokenizer_name]
-    else: 
-        return AutoTokenizer.from_pretrained(tokenizer_name, trust_remote_code=True)
\ No newline at end of file
+    return tokenizer_registry.get(tokenizer_name)
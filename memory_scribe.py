@@ -0,0 +1,191 @@
+from base import Scribe, SQLiteScribe, EMPTY_PAYLOADS
+from metrics import METRICS
+import threading
+import json
+import os
+
+FLUSH_INTERVAL = float(os.getenv('SCRIBE_FLUSH_INTERVAL', '30'))
+
+class MemoryScribe(Scribe):
+    # Rows live in dicts: data[key][id] = (encoded payload, meta JSON), with per-key sets of all ids (claims
+    # included) and of finished ids. Rows are stored encoded so callers get fresh objects like from SQLite.
+    # With persist, existing rows of {project}.db are loaded at startup and finished rows are written back
+    # behind the run every flush_interval seconds (0 for only at shutdown), leaving a standard .db for app.py
+    # and the base.py CLI. Anything finished since the last flush is lost if the process dies.
+    def __init__(self, project, persist = True, flush_interval = FLUSH_INTERVAL):
+        super().__init__(project)
+        self.lock = threading.RLock()
+        self.data = {}
+        self.ids = {}
+        self.done = {}
+        self.dirty = {}
+        self.sink = SQLiteScribe(project) if persist else None
+        self.flush_interval = flush_interval
+        self.flusher = None
+        self.flusher_stop = threading.Event()
+        if self.sink is not None: self._load_sink()
+
+    def _load_sink(self):
+        # unfinished placeholders are left out: in memory they would be claims nobody holds
+        cursor = self.sink._reader().execute("SELECT key, id, payload, meta FROM data WHERE payload != 'null' OR meta != 'null'")
+        for key, id, payload, meta in cursor:
+            self._put(key, id, payload, meta, payload not in EMPTY_PAYLOADS)
+        self.dirty = {}
+
+    def _put(self, key, id, payload, meta, done):
+        self.data.setdefault(key, {})[id] = (payload, meta)
+        self.ids.setdefault(key, set()).add(id)
+        if done: self.done.setdefault(key, set()).add(id)
+        else: self.done.get(key, set()).discard(id)
+        self.dirty[(key, id)] = None
+
+    def _decode(self, row):
+        return self.decode_payload(row[0]), json.loads(row[1])
+
+    def flush(self):
+        if self.sink is None: return 0
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+            # rows deleted since the last flush are deleted from the sink too
+            rows = [(self.sink.UPSERT_SQL, (key, id, *self.data[key][id])) if id in self.data.get(key, {}) else
+                    ('DELETE FROM data WHERE key = ? AND id = ?', (key, id)) for key, id in dirty]
+        if len(rows) == 0: return 0
+        try:
+            self.sink.writer.execute_many(rows, ignore_conflicts=False)
+        except Exception:
+            # keep them dirty for the next flush, newer writes to the same rows win
+            with self.lock:
+                self.dirty = { **dirty, **self.dirty }
+            raise
+        METRICS.inc('scribe_flushed_rows_total', len(rows))
+        return len(rows)
+
+    def _flush_loop(self):
+        while not self.flusher_stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"ERROR: write-behind flush failed: {str(e)}")
+
+    def run_all_steps(self, poll_interval = None):
+        if self.sink is not None and self.flush_interval > 0 and self.flusher is None:
+            self.flusher_stop.clear()
+            self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self.flusher.start()
+        super().run_all_steps(poll_interval)
+
+    def shutdown(self):
+        super().shutdown()
+        if self.flusher is not None:
+            self.flusher_stop.set()
+            self.flusher.join()
+            self.flusher = None
+        flushed = self.flush()
+        if flushed > 0: print(f"Flushed {flushed} rows to {self.sink.dbname}")
+
+    @METRICS.timed('scribe_db_seconds', op='db_start')
+    def db_start(self, key, id):
+        with self.lock:
+            ids = self.ids.setdefault(key, set())
+            if id in ids: return False
+            ids.add(id)
+        self.index.on_start(key, id)
+        return True
+
+    @METRICS.timed('scribe_db_seconds', op='db_end')
+    def db_end(self, key, id, payload, meta):
+        row = (self.encode_payload(key, payload), json.dumps(meta))
+        with self.lock:
+            self._put(key, id, *row, bool(payload))
+        self.index.on_end(key, id, payload, meta)
+
+    @METRICS.timed('scribe_db_seconds', op='db_abort')
+    def db_abort(self, key, id):
+        # like SQLiteScribe, only an unfinished claim is released
+        with self.lock:
+            if id not in self.data.get(key, {}): self.ids.get(key, set()).discard(id)
+        self.index.on_abort(key, id)
+
+    @METRICS.timed('scribe_db_seconds', op='db_delete')
+    def db_delete(self, key, ids):
+        with self.lock:
+            for id in ids:
+                self.data.get(key, {}).pop(id, None)
+                self.ids.get(key, set()).discard(id)
+                self.done.get(key, set()).discard(id)
+                self.dirty[(key, id)] = None
+        for id in ids: self.index.on_abort(key, id)
+
+    @METRICS.timed('scribe_db_seconds', op='db_batch')
+    def db_batch(self, key, rows):
+        encoded = [(id, payload, meta, self.encode_payload(key, payload), json.dumps(meta)) for id, payload, meta in rows]
+        written = []
+        with self.lock:
+            ids = self.ids.setdefault(key, set())
+            for id, payload, meta, encoded_payload, meta_json in encoded:
+                if id in ids: continue
+                self._put(key, id, encoded_payload, meta_json, bool(payload))
+                written.append((id, payload, meta))
+        for id, payload, meta in written:
+            self.index.on_start(key, id)
+            self.index.on_end(key, id, payload, meta)
+        return [id for id, payload, meta in written]
+
+    def load(self, key, id):
+        with self.lock:
+            row = self.data.get(key, {}).get(id)
+        return self._decode(row) if row is not None else (None, None)
+
+    def load_many(self, key, ids):
+        with self.lock:
+            rows = self.data.get(key, {})
+            found = [(id, rows[id]) for id in ids if id in rows]
+        return { id: self._decode(row)[0] for id, row in found }
+
+    def load_meta_many(self, key, ids):
+        with self.lock:
+            rows = self.data.get(key, {})
+            found = [(id, rows[id][1]) for id in ids if id in rows]
+        return { id: json.loads(meta) for id, meta in found }
+
+    def find(self, key=None, id=None):
+        with self.lock:
+            found = []
+            for k in ([key] if key else list(self.ids.keys())):
+                ids = self.ids.get(k, set())
+                for i in ([id] if id else list(ids)):
+                    if i in ids: found.append((k, i, self.data.get(k, {}).get(i)))
+        return [(k, i, *(self._decode(row) if row is not None else (None, None))) for k, i, row in found]
+
+    def find_meta(self, key=None, id=None):
+        # only the stored meta JSON is decoded, payloads are left alone
+        with self.lock:
+            found = []
+            for k in ([key] if key else list(self.ids.keys())):
+                ids = self.ids.get(k, set())
+                for i in ([id] if id else list(ids)):
+                    if i in ids: found.append((k, i, self.data.get(k, {}).get(i)))
+        return [(k, i, json.loads(row[1]) if row is not None else None) for k, i, row in found]
+
+    def all_keys(self):
+        with self.lock:
+            return [key for key, ids in self.ids.items() if len(ids) > 0]
+
+    def all_ids(self):
+        with self.lock:
+            return list(set(id for ids in self.ids.values() for id in ids))
+
+    def find_ids(self, key, done=False):
+        with self.lock:
+            return list(self.done.get(key, set()) if done else self.ids.get(key, set()))
+
+    def count(self, key, done=False):
+        with self.lock:
+            return len(self.done.get(key, set()) if done else self.ids.get(key, set()))
+
+    def exists(self, key, id):
+        with self.lock:
+            return id in self.ids.get(key, set())
+
+    def _scan_ids(self, key):
+        return self.find_ids(key), self.find_ids(key, done=True)
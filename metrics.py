@@ -0,0 +1,127 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import functools
+import json
+import time
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+class Metrics():
+    # Process-wide counters, gauges and histograms keyed by (name, labels). Cheap enough to record
+    # unconditionally; serve() exposes them as Prometheus text on /metrics and JSON on /metrics.json.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.server = None
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value = 1, **labels):
+        with self.lock:
+            key = self._key(name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def add(self, name, value, **labels):
+        with self.lock:
+            key = self._key(name, labels)
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            key = self._key(name, labels)
+            if key not in self.histograms: self.histograms[key] = { 'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0 }
+            hist = self.histograms[key]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound: hist['buckets'][i] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def timed(self, name, **labels):
+        # decorator recording the wall time of every call into histogram `name`
+        def wrap(fn):
+            @functools.wraps(fn)
+            def timed_fn(*args, **kwargs):
+                t0 = time.time()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(name, time.time() - t0, **labels)
+            return timed_fn
+        return wrap
+
+    def quantile(self, hist, q):
+        # linear interpolation inside the bucket holding the q-th observation, like histogram_quantile()
+        if hist['count'] == 0: return None
+        target = q * hist['count']
+        lower, below = 0.0, 0
+        for bound, count in zip(LATENCY_BUCKETS, hist['buckets']):
+            if count >= target: return lower + (bound - lower) * (target - below) / max(1, count - below)
+            lower, below = bound, count
+        return LATENCY_BUCKETS[-1]
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [{ 'name': name, 'labels': dict(labels), 'value': value } for (name, labels), value in self.counters.items()],
+                'gauges': [{ 'name': name, 'labels': dict(labels), 'value': value } for (name, labels), value in self.gauges.items()],
+                'histograms': [{ 'name': name, 'labels': dict(labels), 'count': hist['count'], 'sum': hist['sum'],
+                                 'p50': self.quantile(hist, 0.5), 'p99': self.quantile(hist, 0.99) } for (name, labels), hist in self.histograms.items()]
+            }
+
+    def prometheus(self):
+        def fmt(labels, extra = ()):
+            pairs = list(labels) + list(extra)
+            if len(pairs) == 0: return ''
+            return '{' + ','.join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in pairs) + '}'
+
+        lines = []
+        with self.lock:
+            for kind, series in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted(set(name for name, _ in series)):
+                    lines.append(f'# TYPE {name} {kind}')
+                    lines += [f'{name}{fmt(labels)} {value}' for (n, labels), value in series.items() if n == name]
+            for name in sorted(set(name for name, _ in self.histograms)):
+                lines.append(f'# TYPE {name} histogram')
+                for (n, labels), hist in self.histograms.items():
+                    if n != name: continue
+                    for bound, count in zip(LATENCY_BUCKETS, hist['buckets']):
+                        lines.append(f'{name}_bucket{fmt(labels, [("le", bound)])} {count}')
+                    lines.append(f'{name}_bucket{fmt(labels, [("le", "+Inf")])} {hist["count"]}')
+                    lines.append(f'{name}_sum{fmt(labels)} {hist["sum"]}')
+                    lines.append(f'{name}_count{fmt(labels)} {hist["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host = '127.0.0.1'):
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = metrics.prometheus().encode(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = json.dumps(metrics.snapshot()).encode(), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"Metrics on http://{host}:{self.server.server_port}/metrics and /metrics.json")
+        return self.server.server_port
+
+METRICS = Metrics()
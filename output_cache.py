@@ -0,0 +1,70 @@
+import sqlite3
+import threading
+import hashlib
+import json
+import time
+import os
+
+DEFAULT_CACHE_PATH = os.getenv('SCRIBE_CACHE', os.path.expanduser('~/.cache/scribe/outputs.db'))
+
+class OutputCache():
+    # Content-addressed cache of (payload, meta) for deterministic steps, shared across projects.
+    # Keys hash the step type, its config and the input payload; the file is bounded to max_bytes
+    # by evicting least recently used entries.
+    def __init__(self, path = DEFAULT_CACHE_PATH, max_bytes = 1024*1024*1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS cache
+                           (hash TEXT PRIMARY KEY, payload TEXT, meta TEXT, size INTEGER, last_used REAL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS cache_lru ON cache (last_used)')
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+
+    def key(self, parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, hash):
+        with self.lock:
+            row = self.db.execute('SELECT payload, meta FROM cache WHERE hash = ?', (hash,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute('UPDATE cache SET last_used = ? WHERE hash = ?', (time.time(), hash))
+        return json.loads(row[0]), json.loads(row[1])
+
+    def put(self, hash, payload, meta):
+        payload, meta = json.dumps(payload), json.dumps(meta)
+        size = len(payload) + len(meta)
+        with self.lock:
+            old = self.db.execute('SELECT size FROM cache WHERE hash = ?', (hash,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO cache (hash, payload, meta, size, last_used) VALUES (?, ?, ?, ?, ?)',
+                            (hash, payload, meta, size, time.time()))
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes: self._evict()
+
+    def _evict(self):
+        # other processes may share the file, so re-read the real total before trimming to 90% of the bound
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        target = self.max_bytes * 0.9
+        while self.total_bytes > target:
+            rows = self.db.execute('SELECT hash, size FROM cache ORDER BY last_used LIMIT 256').fetchall()
+            if len(rows) == 0: break
+            self.db.execute('BEGIN')
+            for hash, size in rows:
+                if self.total_bytes <= target: break
+                self.db.execute('DELETE FROM cache WHERE hash = ?', (hash,))
+                self.total_bytes -= size
+                self.evictions += 1
+            self.db.execute('COMMIT')
+
+    def stats(self):
+        return { 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'bytes': self.total_bytes }
@@ -0,0 +1,175 @@
+import threading
+import struct
+import json
+import zlib
+import os
+
+# Encoded payloads are bytes: format version, serializer, compressor, crc32 of the dictionary (0 for none), data.
+# Rows written before codecs existed (or for keys without one) stay JSON text, which is how decode tells them apart.
+HEADER = struct.Struct('<BBBI')
+FORMAT_VERSION = 1
+SERIALIZERS = { 'json': 0, 'msgpack': 1 }
+COMPRESSORS = { 'none': 0, 'zlib': 1, 'zstd': 2 }
+
+class PayloadCodec():
+    # spec is "[json|msgpack][+zlib|+zstd]", e.g. 'zstd', 'msgpack+zlib' or 'msgpack'
+    def __init__(self, spec, dictionary = None, level = None):
+        serializer, compressor = 'json', 'none'
+        for part in spec.split('+'):
+            if part in SERIALIZERS: serializer = part
+            elif part in COMPRESSORS: compressor = part
+            else: raise Exception(f'Unknown codec {part} in {spec}, should be one of: {", ".join([*SERIALIZERS.keys(), *COMPRESSORS.keys()])}')
+        # msgpack and zstandard are imported when a codec needs them, base.py loads this module on every startup
+        try:
+            if serializer == 'msgpack': import msgpack
+            if compressor == 'zstd': import zstandard
+        except ImportError as e:
+            raise Exception(f'Codec {spec} requires the {e.name} package')
+        self.spec = spec
+        self.serializer = serializer
+        self.compressor = compressor
+        self.dictionary = dictionary
+        self.dictionary_id = zlib.crc32(dictionary) if dictionary else 0
+        self.level = level if level is not None else (3 if compressor == 'zstd' else 6)
+        self.local = threading.local()
+
+    def _zstd(self):
+        # zstandard compressors are not thread safe and costly to build with a dictionary, keep one per thread
+        if not hasattr(self.local, 'zstd'):
+            import zstandard
+            zdict = zstandard.ZstdCompressionDict(self.dictionary) if self.dictionary else None
+            self.local.zstd = zstandard.ZstdCompressor(level=self.level, dict_data=zdict)
+        return self.local.zstd
+
+    def encode(self, value):
+        # serializes once; with the json serializer that text is returned as is when encoding would not shrink it
+        # (tiny payloads grow under compression), msgpack payloads are always kept encoded
+        if self.serializer == 'msgpack':
+            import msgpack
+            data = msgpack.packb(value)
+        else:
+            data = json.dumps(value, separators=(',', ':')).encode()
+        text = data if self.serializer == 'json' else None
+        if self.compressor == 'zlib':
+            compressor = zlib.compressobj(self.level, zdict=self.dictionary) if self.dictionary else zlib.compressobj(self.level)
+            data = compressor.compress(data) + compressor.flush()
+        elif self.compressor == 'zstd':
+            data = self._zstd().compress(data)
+        encoded = HEADER.pack(FORMAT_VERSION, SERIALIZERS[self.serializer], COMPRESSORS[self.compressor], self.dictionary_id) + data
+        return text.decode() if text is not None and len(text) <= len(encoded) else encoded
+
+class PayloadCodecs():
+    # The codecs configured per key for one project, and the dictionaries rows refer to. Dictionaries are
+    # copied under root by crc32 when configured, so any reader of the project can decode without the config.
+    def __init__(self, root):
+        self.root = root
+        self.codecs = {}
+        self.dictionaries = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def configure(self, key, spec, dictionary_path = None, level = None):
+        dictionary = None
+        if dictionary_path is not None:
+            with open(dictionary_path, 'rb') as f:
+                dictionary = f.read()
+            self._save_dictionary(dictionary)
+        self.codecs[key] = PayloadCodec(spec, dictionary, level) if spec != 'json' or dictionary is not None else None
+
+    def _save_dictionary(self, dictionary):
+        dictionary_id = zlib.crc32(dictionary)
+        self.dictionaries[dictionary_id] = dictionary
+        path = os.path.join(self.root, f'{dictionary_id:08x}')
+        if os.path.exists(path): return
+        os.makedirs(self.root, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(dictionary)
+        os.replace(path + '.tmp', path)
+
+    def _dictionary(self, dictionary_id):
+        with self.lock:
+            if dictionary_id not in self.dictionaries:
+                path = os.path.join(self.root, f'{dictionary_id:08x}')
+                if not os.path.exists(path): raise Exception(f'Payload dictionary {dictionary_id:08x} not found in {self.root}')
+                with open(path, 'rb') as f:
+                    self.dictionaries[dictionary_id] = f.read()
+            return self.dictionaries[dictionary_id]
+
+    def _zstd(self, dictionary_id, dictionary):
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('Reading zstd payloads requires the zstandard package')
+        if not hasattr(self.local, 'zstd'): self.local.zstd = {}
+        if dictionary_id not in self.local.zstd:
+            zdict = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            self.local.zstd[dictionary_id] = zstandard.ZstdDecompressor(dict_data=zdict)
+        return self.local.zstd[dictionary_id]
+
+    def encode(self, key, value):
+        # empty payloads stay JSON text: 'null', '""', '[]' etc. are how the backends tell unfinished rows apart
+        codec = self.codecs.get(key)
+        if codec is None or not value: return json.dumps(value)
+        return codec.encode(value)
+
+    def decode(self, raw):
+        if isinstance(raw, str): return json.loads(raw)
+        raw = bytes(raw)
+        version, serializer, compressor, dictionary_id = HEADER.unpack_from(raw)
+        if version != FORMAT_VERSION: raise Exception(f'Unsupported payload format version {version}')
+        data = raw[HEADER.size:]
+        dictionary = self._dictionary(dictionary_id) if dictionary_id else None
+        if compressor == COMPRESSORS['zlib']:
+            decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+            data = decompressor.decompress(data) + decompressor.flush()
+        elif compressor == COMPRESSORS['zstd']:
+            data = self._zstd(dictionary_id, dictionary).decompress(data)
+        if serializer == SERIALIZERS['msgpack']:
+            try:
+                import msgpack
+            except ImportError:
+                raise Exception('Reading msgpack payloads requires the msgpack package')
+            return msgpack.unpackb(data)
+        return json.loads(data)
+
+def train_dictionary(samples, size = 32 * 1024):
+    # zstd trains a real dictionary; for zlib a preset dictionary is just text that later payloads can reference,
+    # so samples are packed in up to size (zlib only looks at the last 32KB of it)
+    samples = [json.dumps(s, separators=(',', ':')).encode() for s in samples if s]
+    try:
+        import zstandard
+        return zstandard.train_dictionary(size, samples).as_bytes()
+    except ImportError:
+        pass
+    dictionary = b''
+    for sample in samples:
+        if len(dictionary) + len(sample) > size: break
+        dictionary = sample + dictionary
+    return dictionary
+
+if __name__ == "__main__":
+    import argparse
+    from base import SQLiteScribe
+
+    parser = argparse.ArgumentParser(description="Train payload dictionaries and re-encode stored rows")
+    parser.add_argument("--project", type=str, required=True, help="Project name")
+    parser.add_argument("--key", type=str, required=True, help="Key whose payloads to sample or re-encode")
+    parser.add_argument("--train", type=str, help="Write a dictionary trained on up to --samples payloads to this file")
+    parser.add_argument("--samples", type=int, default=2000, help="Payloads to train on")
+    parser.add_argument("--size", type=int, default=32 * 1024, help="Dictionary size in bytes")
+    parser.add_argument("--recode", type=str, help="Re-encode every stored payload of --key with this codec (json to decode back)")
+    parser.add_argument("--dict", type=str, help="Dictionary file for --recode")
+    args = parser.parse_args()
+
+    scr = SQLiteScribe(args.project)
+    if args.train:
+        ids = scr.find_ids(args.key, done=True)[:args.samples]
+        dictionary = train_dictionary([scr.blobs.pack(payload) for payload in scr.load_many(args.key, ids).values()], args.size)
+        with open(args.train, 'wb') as f:
+            f.write(dictionary)
+        print(f"Trained a {len(dictionary)} byte dictionary on {len(ids)} {args.key} payloads")
+    if args.recode:
+        scr.set_codec(args.key, args.recode, args.dict)
+        before, after = scr.recode(args.key)
+        print(f"Re-encoded {args.key}: {before/1024/1024:.1f}MB -> {after/1024/1024:.1f}MB, run VACUUM to return the space to the filesystem")
+    scr.shutdown()
@@ -0,0 +1,342 @@
+from base import Scribe
+from metrics import METRICS
+import threading
+import struct
+import fcntl
+import json
+import zlib
+import os
+
+# record framing: body length and crc32 of the body, then the JSON body [key, id, payload, meta]; a payload
+# stored with a binary codec follows the JSON (which then holds null for it) after a newline. A body of just
+# [key, id] is a tombstone for a deleted row.
+HEADER = struct.Struct('<II')
+SEGMENT_BYTES = int(os.getenv('SCRIBE_SEGMENT_BYTES', str(64*1024*1024)))
+
+class SegmentLogScribe(Scribe):
+    # Append-only storage under {project}.log/: finished rows are appended to numbered segment files and found
+    # through an in-memory (key, id) -> (segment, offset, length, done) index. The index is checkpointed on
+    # shutdown and after compaction; at startup the checkpoint is loaded and only segment bytes written after it
+    # are replayed (everything is replayed when there is no usable checkpoint). A later record for the same
+    # (key, id) supersedes the earlier one, compaction rewrites the live rows once half the log is dead.
+    #
+    # Claims are only kept in memory: the directory is locked to one process, and a claim that never finished
+    # was never written, so after a crash it is simply pending again.
+    def __init__(self, project, segment_bytes = SEGMENT_BYTES):
+        super().__init__(project)
+        self.root = f'{project}.log'
+        self.segment_bytes = segment_bytes
+        self.lock = threading.RLock()
+        self.rows = {}
+        self.readers = {}
+        self.sizes = {}
+        self.dead = {}
+        self.active = None
+        self.closed = False
+
+        os.makedirs(self.root, exist_ok=True)
+        self.lock_file = open(os.path.join(self.root, 'LOCK'), 'w')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise Exception(f'{self.root} is in use by another process, the segment log supports a single writer')
+        self._recover()
+        self._open_segment(max(self.sizes, default=0) + 1)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.root, f'{segment:08d}.seg')
+
+    def _checkpoint_path(self):
+        return os.path.join(self.root, 'index.ckpt')
+
+    def _segments_on_disk(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.root) if name.endswith('.seg'))
+
+    def _recover(self):
+        segments = self._segments_on_disk()
+        replay_from = { segment: 0 for segment in segments }
+        checkpoint = self._load_checkpoint()
+        covered = { int(s): size for s, size in checkpoint['sizes'].items() } if checkpoint is not None else {}
+        if checkpoint is not None and all(s in replay_from and os.path.getsize(self._segment_path(s)) >= size for s, size in covered.items()):
+            self.rows = { key: { id: tuple(loc) for id, loc in ids.items() } for key, ids in checkpoint['rows'].items() }
+            self.dead = { int(s): size for s, size in checkpoint['dead'].items() }
+            replay_from.update(covered)
+            # older segments the checkpoint does not list were compacted away, only the delete did not happen
+            for segment in [s for s in segments if s not in covered and s < max(covered, default=0)]:
+                os.remove(self._segment_path(segment))
+                segments.remove(segment)
+        elif len(segments) > 0:
+            print(f'Rebuilding index of {self.root} from {len(segments)} segments')
+        for segment in segments:
+            self.sizes[segment] = self._replay(segment, replay_from[segment])
+            if self.sizes[segment] == 0:
+                os.remove(self._segment_path(segment))
+                del self.sizes[segment]
+
+    def _load_checkpoint(self):
+        try:
+            with open(self._checkpoint_path()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _replay(self, segment, offset):
+        # applies the records after offset to the index; a torn or corrupt tail from a crash is cut off
+        path = self._segment_path(segment)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        pos = 0
+        while pos + HEADER.size <= len(data):
+            length, crc = HEADER.unpack_from(data, pos)
+            body = data[pos + HEADER.size:pos + HEADER.size + length]
+            if len(body) < length or zlib.crc32(body) != crc: break
+            head, binary, _ = body.partition(b'\n')
+            record = json.loads(head)
+            if len(record) == 2: self._remove(*record, segment, HEADER.size + length)
+            else: self._place(record[0], record[1], (segment, offset + pos, HEADER.size + length, bool(record[2]) or len(binary) > 0))
+            pos += HEADER.size + length
+        if pos < len(data):
+            print(f'WARNING: {path} has a damaged tail, truncating {len(data) - pos} bytes')
+            with open(path, 'r+b') as f:
+                f.truncate(offset + pos)
+        return offset + pos
+
+    def _place(self, key, id, loc):
+        old = self.rows.setdefault(key, {}).get(id)
+        if old is not None: self.dead[old[0]] = self.dead.get(old[0], 0) + old[2]
+        self.rows[key][id] = loc
+
+    def _remove(self, key, id, segment, length):
+        # the tombstone itself is dead weight as soon as it is written, compaction leaves it behind
+        old = self.rows.get(key, {}).pop(id, None)
+        if old is not None: self.dead[old[0]] = self.dead.get(old[0], 0) + old[2]
+        self.dead[segment] = self.dead.get(segment, 0) + length
+
+    def _open_segment(self, segment):
+        if self.active is not None:
+            self.active.flush()
+            os.fsync(self.active.fileno())
+            self.active.close()
+        self.active_segment = segment
+        self.active = open(self._segment_path(segment), 'ab')
+        self.sizes[segment] = self.active.tell()
+
+    def _append(self, records):
+        # records are (key, id, body, done); one write and flush for all of them
+        segment, offset = self.active_segment, self.sizes[self.active_segment]
+        chunks = []
+        for key, id, body, done in records:
+            chunks.append(HEADER.pack(len(body), zlib.crc32(body)) + body)
+            self._place(key, id, (segment, offset, HEADER.size + len(body), done))
+            offset += HEADER.size + len(body)
+        self.active.write(b''.join(chunks))
+        self.active.flush()
+        self.sizes[segment] = offset
+        if offset >= self.segment_bytes: self._roll()
+
+    def _roll(self):
+        total = sum(self.sizes.values())
+        if sum(self.dead.values()) * 2 > total: self.compact()
+        else: self._open_segment(self.active_segment + 1)
+
+    def _encode(self, key, id, payload, meta):
+        encoded = self.encode_payload(key, payload)
+        if isinstance(encoded, bytes): return json.dumps([key, id, None, meta]).encode() + b'\n' + encoded
+        return f'[{json.dumps(key)}, {json.dumps(id)}, {encoded}, {json.dumps(meta)}]'.encode()
+
+    def _read(self, loc):
+        # raw record bytes, called with the lock held so compaction cannot remove the segment underneath
+        segment, offset, length, done = loc
+        if segment not in self.readers: self.readers[segment] = os.open(self._segment_path(segment), os.O_RDONLY)
+        return os.pread(self.readers[segment], length, offset)
+
+    def _decode(self, record):
+        head, binary, encoded = record[HEADER.size:].partition(b'\n')
+        key, id, payload, meta = json.loads(head)
+        return self.decode_payload(encoded) if binary else self.blobs.unpack(payload), meta
+
+    def _meta(self, record):
+        return json.loads(record[HEADER.size:].partition(b'\n')[0])[3]
+
+    def _get(self, key, id):
+        with self.lock:
+            loc = self.rows.get(key, {}).get(id)
+            # a claimed row that has not finished reads like SQLite's 'null' placeholder
+            if loc is None: return None, None
+            record = self._read(loc)
+        return self._decode(record)
+
+    def compact(self):
+        # rewrites every live row into fresh segments, checkpoints, then drops the old segments
+        with self.lock:
+            old_segments = list(self.sizes.keys())
+            live = [(key, id, loc) for key, ids in self.rows.items() for id, loc in ids.items() if loc is not None]
+            before = sum(self.sizes.values())
+            self.dead = {}
+            self._open_segment(self.active_segment + 1)
+            for key, id, loc in live:
+                segment, offset, length, done = loc
+                record = self._read(loc)
+                self.rows[key][id] = (self.active_segment, self.sizes[self.active_segment], length, done)
+                self.active.write(record)
+                self.sizes[self.active_segment] += length
+                if self.sizes[self.active_segment] >= self.segment_bytes: self._open_segment(self.active_segment + 1)
+            self._open_segment(self.active_segment + 1)
+            for segment in old_segments: del self.sizes[segment]
+            self.checkpoint()
+            for segment in old_segments:
+                if segment in self.readers: os.close(self.readers.pop(segment))
+                os.remove(self._segment_path(segment))
+            print(f'Compacted {self.root}: {before/1024/1024:.1f}MB -> {sum(self.sizes.values())/1024/1024:.1f}MB')
+
+    def checkpoint(self):
+        with self.lock:
+            self.active.flush()
+            os.fsync(self.active.fileno())
+            state = {
+                'sizes': self.sizes,
+                'dead': self.dead,
+                'rows': { key: { id: loc for id, loc in ids.items() if loc is not None } for key, ids in self.rows.items() }
+            }
+            tmp = self._checkpoint_path() + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp, self._checkpoint_path())
+
+    def shutdown(self):
+        super().shutdown()
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self.closed: return
+            self.closed = True
+            self.checkpoint()
+            self.active.close()
+            for fd in self.readers.values(): os.close(fd)
+            self.readers = {}
+            self.lock_file.close()
+
+    @METRICS.timed('scribe_db_seconds', op='db_start')
+    def db_start(self, key, id):
+        with self.lock:
+            ids = self.rows.setdefault(key, {})
+            if id in ids: return False
+            ids[id] = None
+        self.index.on_start(key, id)
+        return True
+
+    @METRICS.timed('scribe_db_seconds', op='db_end')
+    def db_end(self, key, id, payload, meta):
+        body = self._encode(key, id, payload, meta)
+        with self.lock:
+            self._append([(key, id, body, bool(payload))])
+        self.index.on_end(key, id, payload, meta)
+
+    @METRICS.timed('scribe_db_seconds', op='db_abort')
+    def db_abort(self, key, id):
+        # like SQLiteScribe, only an unfinished claim is released
+        with self.lock:
+            ids = self.rows.get(key, {})
+            if id in ids and ids[id] is None: del ids[id]
+        self.index.on_abort(key, id)
+
+    @METRICS.timed('scribe_db_seconds', op='db_delete')
+    def db_delete(self, key, ids):
+        with self.lock:
+            stored = [id for id in ids if self.rows.get(key, {}).get(id) is not None]
+            for id in ids:
+                if self.rows.get(key, {}).get(id, 0) is None: del self.rows[key][id]
+            if len(stored) > 0:
+                tombstones = [HEADER.pack(len(body), zlib.crc32(body)) + body for body in (json.dumps([key, id]).encode() for id in stored)]
+                segment = self.active_segment
+                self.active.write(b''.join(tombstones))
+                self.active.flush()
+                for id, tombstone in zip(stored, tombstones): self._remove(key, id, segment, len(tombstone))
+                self.sizes[segment] += sum(len(t) for t in tombstones)
+                if self.sizes[segment] >= self.segment_bytes: self._roll()
+        for id in ids: self.index.on_abort(key, id)
+
+    @METRICS.timed('scribe_db_seconds', op='db_batch')
+    def db_batch(self, key, rows):
+        encoded = [(id, payload, meta, self._encode(key, id, payload, meta)) for id, payload, meta in rows]
+        with self.lock:
+            ids = self.rows.setdefault(key, {})
+            fresh = [(id, payload, meta, body) for id, payload, meta, body in encoded if id not in ids]
+            self._append([(key, id, body, bool(payload)) for id, payload, meta, body in fresh])
+        for id, payload, meta, body in fresh:
+            self.index.on_start(key, id)
+            self.index.on_end(key, id, payload, meta)
+        return [id for id, payload, meta, body in fresh]
+
+    @METRICS.timed('scribe_db_seconds', op='load')
+    def load(self, key, id):
+        return self._get(key, id)
+
+    @METRICS.timed('scribe_db_seconds', op='load_many')
+    def load_many(self, key, ids):
+        with self.lock:
+            locs = self.rows.get(key, {})
+            # read in log order, so a large load walks the segments forward
+            found = sorted(((locs[id], id) for id in ids if locs.get(id) is not None), key=lambda x: x[0][:2])
+            records = [(id, self._read(loc)) for loc, id in found]
+        return { id: self._decode(record)[0] for id, record in records }
+
+    @METRICS.timed('scribe_db_seconds', op='load_meta_many')
+    def load_meta_many(self, key, ids):
+        with self.lock:
+            locs = self.rows.get(key, {})
+            found = sorted(((locs[id], id) for id in ids if locs.get(id) is not None), key=lambda x: x[0][:2])
+            records = [(id, self._read(loc)) for loc, id in found]
+        return { id: self._meta(record) for id, record in records }
+
+    @METRICS.timed('scribe_db_seconds', op='find')
+    def find(self, key=None, id=None):
+        with self.lock:
+            keys = [key] if key else list(self.rows.keys())
+            records = []
+            for k in keys:
+                ids = self.rows.get(k, {})
+                for i in ([id] if id else list(ids.keys())):
+                    if i in ids: records.append((k, i, self._read(ids[i]) if ids[i] is not None else None))
+        return [(k, i, *(self._decode(record) if record is not None else (None, None))) for k, i, record in records]
+
+    def all_keys(self):
+        with self.lock:
+            return [key for key, ids in self.rows.items() if len(ids) > 0]
+
+    def all_ids(self):
+        with self.lock:
+            return list(set(id for ids in self.rows.values() for id in ids))
+
+    @METRICS.timed('scribe_db_seconds', op='find_ids')
+    def find_ids(self, key, done=False):
+        with self.lock:
+            return [id for id, loc in self.rows.get(key, {}).items() if not done or (loc is not None and loc[3])]
+
+    @METRICS.timed('scribe_db_seconds', op='find_meta')
+    @METRICS.timed('scribe_db_seconds', op='find_meta')
+    def find_meta(self, key=None, id=None):
+        # like load_meta_many, only the JSON head is parsed: no binary payload decoding, no blob handles
+        with self.lock:
+            records = []
+            for k in ([key] if key else list(self.rows.keys())):
+                locs = self.rows.get(k, {})
+                found = sorted(((locs[i], i) for i in ([id] if id else list(locs.keys())) if i in locs), key=lambda x: x[0][:2] if x[0] is not None else (0, 0))
+                records += [(k, i, self._read(loc) if loc is not None else None) for loc, i in found]
+        return [(k, i, self._meta(record) if record is not None else None) for k, i, record in records]
+
+    @METRICS.timed('scribe_db_seconds', op='count')
+    def count(self, key, done=False):
+        with self.lock:
+            if not done: return len(self.rows.get(key, {}))
+            return sum(1 for loc in self.rows.get(key, {}).values() if loc is not None and loc[3])
+
+    def exists(self, key, id):
+        with self.lock:
+            return id in self.rows.get(key, {})
+
+    @METRICS.timed('scribe_db_seconds', op='scan_ids')
+    def _scan_ids(self, key):
+        return self.find_ids(key), self.find_ids(key, done=True)
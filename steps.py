@@ -1,12 +1,27 @@
-from llm_tools import build_tokenizer, universal_llm_request, simple_extract_json
+from llm_tools import build_tokenizer, universal_llm_request, universal_llm_request_async, universal_llm_request_stream, universal_llm_request_stream_async, batched_llm_request, simple_extract_json
+from http_tools import post_json, async_post_json
+from endpoint_pool import get_pool
+from concurrency import build_limiter
+from export_tools import ShardWriter
 from jinja2 import Template
+from base import Blob, FanOut
+import hashlib
 import uuid
 import time
-import requests
 import os
 import json
+import base64
+import shutil
+import functools
+import asyncio
+
+# params that change how a step is scheduled but not what it computes, left out of cache keys
+SCHEDULING_PARAMS = ('parallel', 'qdepth', 'executor', 'batch_size', 'batch_prompts', 'batch_wait', 'model_max', 'max', 'cache', 'pool', 'limiter', 'min_parallel', 'max_parallel', 'latency_max', 'watermark', 'codec', 'codec_dict')
 
 class TransformStep:
+  default_executor = 'thread'
+  deterministic = False
+
   def __init__(self, step:str, outkey:str, inkey:str = None, **params):
     self.step = step
     self.inkey = inkey
@@ -15,80 +30,266 @@ class TransformStep:
     
     self.core = None
     self.queue = None
+    self.limiter = None
     self.futures = {}
+    self.queued = set()
     
   def run(self, id, input):
     raise Exception('run() must be implemented.')
 
-  def pending_inputs(self, all_inputs = None, all_outputs = None):
-    if all_inputs is None: all_inputs = self.core.find(key=self.inkey)
-    if all_outputs is None: all_outputs = self.core.find(key=self.outkey)
-    inputs = [ (id, payload) for key, id, payload, meta in all_inputs if payload ]
-    outputs = [ id for key, id, payload, meta in all_outputs ]
-    queued = list(self.futures.keys())
-    return [ (input_id, payload) for input_id, payload in inputs if input_id not in outputs and input_id not in queued ]
+  def pending_ids(self, limit = None):
+    return self.core.pending_ids(self.inkey, self.outkey, exclude=self.queued, limit=limit)
+
+  def backlog(self):
+    return self.core.pending_count(self.inkey, self.outkey, exclude=self.inflight_ids())
+
+  def inflight_ids(self):
+    # batch futures carry the ids they cover, single-item futures are keyed by their id
+    return [ id for key, future in self.futures.items() for id in getattr(future, 'ids', [key]) ]
+
+  def work_in_progress(self):
+    # ids this step still has to process this run: inputs it has not tried yet plus jobs in flight
+    self.unfinished_futures()
+    return self.core.pending_count(self.inkey, self.outkey, exclude=self.queued) + len(self.inflight_ids())
+
+  def watermark(self):
+    # watermark=N stops admitting new ids while the steps below this one hold N or more ids of work
+    return int(self.params['watermark']) if 'watermark' in self.params else None
+
+  def load_input(self, id):
+    payload, meta = self.core.load(self.inkey, id)
+    return payload
+
+  def pending_inputs(self):
+    inputs = [ (id, self.load_input(id)) for id in self.pending_ids() ]
+    return [ (id, payload) for id, payload in inputs if payload ]
 
   def setup(self, core):
     self.core = core
+    # codec=zlib|zstd|msgpack[+zlib|+zstd] (optionally codec_dict=file) stores this step's outputs encoded
+    if 'codec' in self.params and self.outkey is not None: core.set_codec(self.outkey, self.params['codec'], self.params.get('codec_dict'))
+    # limiter=aimd|gradient adapts the in-flight limit between min_parallel and max_parallel, starting from parallel
+    kind = self.params.get('limiter')
+    if kind is not None and not self.is_batch():
+      parallel = int(self.params.get('parallel', '1'))
+      latency_max = { 'latency_max': float(self.params['latency_max']) } if 'latency_max' in self.params else {}
+      self.limiter = build_limiter(self.step, kind, parallel, int(self.params.get('min_parallel', '1')),
+                                   int(self.params.get('max_parallel', str(parallel * 4))), **latency_max)
+
+  def num_workers(self):
+    if self.limiter is not None: return self.limiter.max_limit
+    return int(self.params.get('parallel', '1'))
+
+  def queue_capacity(self):
+    if self.limiter is not None: return self.limiter.limit
+    return int(self.params.get('qdepth', self.params.get('parallel', '1')))
 
   def queue_full(self):
-    qdepth = self.params.get('qdepth')
-    if qdepth is None: return False
-    return len(self.unfinished_futures()) >= int(qdepth)
+    return len(self.unfinished_futures()) >= self.queue_capacity()
+
+  def resolved_params(self):
+    # params may be zero-argument callables (e.g. a lazily built schema), resolve them once
+    for k, v in list(self.params.items()):
+      if callable(v): self.params[k] = v()
+    return self.params
+
+  def is_cacheable(self):
+    return self.deterministic and self.params.get('cache', '1') != '0'
+
+  def cache_key(self, input):
+    params = { k: v for k, v in self.resolved_params().items() if k not in SCHEDULING_PARAMS }
+    return { 'step': type(self).__name__, 'params': params, 'input': input }
+
+  def executor(self):
+    return self.params.get('executor', self.default_executor)
+
+  def is_async(self):
+    # executor=async runs the step's arun() coroutine on the shared event loop instead of a thread pool
+    return self.executor() == 'async' and hasattr(self, 'arun')
+
+  def is_batch(self):
+    # executor=batch runs batch_size inputs per job and commits them in one transaction
+    return self.executor() == 'batch'
+
+  def batch_size(self):
+    return int(self.params.get('batch_size', '1000'))
+
+  def run_batch(self, items):
+    results = []
+    for id, input in items:
+      try:
+        results.append(self.run(id, input))
+      except Exception as e:
+        print(f"ERROR: {self.step} for {id} crashed: {str(e)}")
+        results.append((None, None))
+    return results
+
+  def finish(self):
+    # called once the step's queue has drained at shutdown
+    pass
 
   def unfinished_futures(self):
     if self.queue is None: return []
-    return [future for id, future in self.futures.items() if not future.done()]
+    # finished futures are dropped here; self.queued still remembers their ids so failed jobs are not retried this run
+    self.futures = { id: future for id, future in self.futures.items() if not future.done() }
+    return list(self.futures.values())
 
 class ExportStep(TransformStep):
+  # Every exported id gets a done-marker under marker= (default exported.<step>): what was written and a hash of what
+  # it was written from. Exports are then pending like any other step, so a run only exports ids that are new since
+  # the last one. reexport=all drops every marker first, reexport=changed only those whose inputs hash differently.
   def __init__(self, step:str, inkey:str, **params):
-    super().__init__(step, None, inkey, **params)
+    super().__init__(step, params.get('marker', f'exported.{step}'), inkey, **params)
+
+  def setup(self, core):
+    # resolved here, not in __init__: init_pipeline applies CLI params to the step after it is constructed
+    self.outkey = self.params.get('marker', f'exported.{self.step}')
+    super().setup(core)
+    mode = self.params.get('reexport')
+    if mode is None: return
+    if mode not in ('all', 'changed'): raise Exception(f'{self.step} reexport should be all or changed, not {mode}')
+    ids = core.find_ids(self.outkey) if mode == 'all' else self.changed_ids()
+    core.db_delete(self.outkey, ids)
+    print(f"{self.step} will re-export {len(ids)} ids")
+
+  def changed_ids(self, chunk = 1000):
+    markers = { id: meta.get('hash') if meta else None for _, id, meta in self.core.find_meta(key=self.outkey) }
+    ids = list(markers.keys())
+    changed = []
+    for i in range(0, len(ids), chunk):
+      hashes = self.export_hashes(ids[i:i+chunk])
+      changed += [id for id in ids[i:i+chunk] if hashes.get(id) != markers[id]]
+    return changed
 
-  def pending_inputs(self, all_inputs = None, all_outputs = None):
-    if all_inputs is None: all_inputs = self.core.find(key=self.inkey)
-    inputs = [ (id, payload) for key, id, payload, meta in all_inputs if payload ]    
-    queued = list(self.futures.keys())
-    return [ (input_id, payload) for input_id, payload in inputs if input_id not in queued ]
+  def export_hashes(self, ids):
+    return { id: self.export_hash(payload) for id, payload in self.core.load_many(self.inkey, ids).items() }
+
+  def export_hash(self, value):
+    return hashlib.sha256(json.dumps(self.core.blobs.pack(value), sort_keys=True).encode()).hexdigest()[:16]
         
 class StepJSONExport(ExportStep):
   def run(self, id, input):
       os.makedirs(self.core.project, exist_ok=True)
-      fname = f"{self.core.project}/{id}.json"
-      with open(fname,"w") as f:
+      if isinstance(input, Blob):
+        fname = f"{self.core.project}/{id}.bin"
+        shutil.copyfile(input.path, fname)
+      else:
+        fname = f"{self.core.project}/{id}.json"
+        with open(fname,"w") as f:
           if isinstance(input, str):
             f.write(input)
           else:
             json.dump(input, f, indent=2)
       print(f"{self.step} wrote {fname}")
-      return None, None
+      return fname, { 'hash': self.export_hash(input) }
+
+class StepBulkExport(ExportStep):
+  # Streams finished ids into sharded files, one row per id: {"id", <key>: payload for each of keys=, <key>_meta for
+  # each of meta=}. keys defaults to the inkey, which should be the last of them so every joined key is finished.
+  # Keys from above a fan-out (n>1) are joined through the parent in the samples' meta, so the fanned-out key has to
+  # be among keys= or meta=; a joined key that still cannot be found is reported and exported as null.
+  # format=jsonl|jsonl.gz|jsonl.zst|parquet, shard_rows=N, path= (default the project directory). Runs on the batch
+  # executor, so memory is bounded by batch_size rows whatever the size of the project.
+  default_executor = 'batch'
+
+  def setup(self, core):
+    self.keys = self.params.get('keys', self.inkey).split(',')
+    self.meta_keys = [k for k in self.params.get('meta', '').split(',') if k]
+    super().setup(core)
+    self.writer = ShardWriter(self.params.get('path', core.project), self.params.get('prefix', self.step.lower()),
+                              ['id', *self.keys, *[f'{k}_meta' for k in self.meta_keys]],
+                              self.params.get('format', 'jsonl'), int(self.params.get('shard_rows', '100000')))
+
+    # markers of rows that went into a shard its (now dead) writer never completed are dropped to export them again;
+    # shards still being written by live workers exporting the same project are not abandoned
+    if len(self.writer.abandoned) > 0:
+      lost = [id for _, id, shard, _ in core.find(key=self.outkey) if shard in self.writer.abandoned]
+      core.db_delete(self.outkey, lost)
+      print(f"{self.step} dropped {len(self.writer.abandoned)} incomplete shards, re-exporting their {len(lost)} ids")
+
+  def rows(self, ids, inputs = None):
+    payloads = { key: inputs if key == self.inkey and inputs is not None else self.core.load_many(key, ids) for key in self.keys }
+    metas = { key: self.core.load_meta_many(key, ids) for key in self.meta_keys }
+    self.join_lineage(ids, payloads, metas)
+    pack = self.core.blobs.pack
+    return [{ 'id': id, **{ key: pack(payloads[key].get(id)) for key in self.keys }, **{ f'{key}_meta': metas[key].get(id) for key in self.meta_keys } } for id in ids]
+
+  def join_lineage(self, ids, payloads, metas):
+    # walks missing ids up their parent lineage, filling payloads and metas in place with what the ancestors hold
+    lineage_keys = list(dict.fromkeys([*self.meta_keys, *self.keys]))
+    ancestors = { id: id for id in ids if any(id not in payloads[key] for key in self.keys) or any(id not in metas[key] for key in self.meta_keys) }
+    while len(ancestors) > 0:
+      at = list(set(ancestors.values()))
+      lineage = [self.core.load_meta_many(key, at) for key in lineage_keys]
+      parents = { id: next((found[id]['parent'] for found in lineage if id in found and 'parent' in (found[id] or {})), None) for id in at }
+      ancestors = { id: parents[ancestor] for id, ancestor in ancestors.items() if parents[ancestor] is not None }
+      for key in self.keys:
+        found = self.core.load_many(key, [ancestors[id] for id in ancestors if id not in payloads[key]])
+        payloads[key].update({ id: found[ancestors[id]] for id in ancestors if id not in payloads[key] and ancestors[id] in found })
+      for key in self.meta_keys:
+        found = self.core.load_meta_many(key, [ancestors[id] for id in ancestors if id not in metas[key]])
+        metas[key].update({ id: found[ancestors[id]] for id in ancestors if id not in metas[key] and ancestors[id] in found })
+      ancestors = { id: ancestor for id, ancestor in ancestors.items() if any(id not in payloads[key] for key in self.keys) or any(id not in metas[key] for key in self.meta_keys) }
+    unjoined = [key for key in self.keys if any(id not in payloads[key] for id in ids)]
+    if len(unjoined) > 0: print(f"WARNING: {self.step} found no {', '.join(unjoined)} for some ids, neither under the id nor its parents; exporting null")
+
+  def export_hashes(self, ids):
+    return { row.pop('id'): self.export_hash(row) for row in self.rows(ids) }
+
+  def run_batch(self, items):
+    rows = self.rows([id for id, input in items], dict(items))
+    hashes = [self.export_hash({ k: v for k, v in row.items() if k != 'id' }) for row in rows]
+    shards = self.writer.write(rows)
+    return [(shard, { 'hash': hash }) for shard, hash in zip(shards, hashes)]
+
+  def finish(self):
+    self.writer.close()
 
 class GenerateStep(TransformStep):
   def __init__(self, step:str, outkey:str, **params):
     super().__init__(step, outkey, None, **params)
     
-  def pending_inputs(self):
+  def pending_ids(self, limit = None):
+    num_pending = self.backlog()
+    if limit is not None: num_pending = min(num_pending, limit)
+    return [ str(uuid.uuid4()) for _ in range(num_pending) ]
+
+  def backlog(self):
     num_samples = int(self.params.get('max', '0'))
     if not num_samples: raise Exception(f'{self.step} requires a max parameter.')
-    outputs = [x[0] for x in self.core.find(self.outkey)]
-    return [ (str(uuid.uuid4()), None) for _ in range(max(0,num_samples - len(outputs))) ]
+    # in-flight jobs may already have claimed their row, so this undercounts until they finish - never over-generates
+    num_outputs = self.core.count(self.outkey) + len(self.unfinished_futures())
+    return max(0, num_samples - num_outputs)
+
+  def load_input(self, id):
+    return None
+
+@functools.lru_cache(maxsize=64)
+def compile_template(text):
+    return Template(text)
 
 class StepExpandTemplate(TransformStep):
+    default_executor = 'batch'
+    deterministic = True
+
     def run(self, id, input):
-        tpl = Template(self.params.get('template'))
+        tpl = compile_template(self.params.get('template'))
         text = tpl.render(**input)        
         return text, {}
         
 class StepLLMCompletion(TransformStep):
-    def pending_inputs(self):        
-        all_inputs = self.core.find(key=self.inkey)
-        all_outputs = self.core.find(key=self.outkey)
-        
+    def setup(self, core):
+        super().setup(core)
+        # load the tokenizer when the step is configured so the cold start is paid (and reported) once, up front
+        build_tokenizer(self.params.get('tokenizer'))
+
+    def pending_ids(self, limit = None):        
         model_max = self.params.get('model_max')
         if model_max is not None: 
             model = self.params.get('model')
             model_max = int(model_max)
-            model_count = len([id for key, id, payload, meta in all_outputs if meta is not None and meta['model'] == model])
-            if model_count >= model_max:
+            # counted by the pending index, which keeps it current as outputs land
+            if self.core.model_count(self.outkey, model) >= model_max:
                 print(f"{self.step} hit model_max={model_max} for model={model}")
                 return []
 
@@ -102,9 +303,9 @@ class StepLLMCompletion(TransformStep):
         }
                 
         # Original logic if model_max isn't hit.
-        return super().pending_inputs(all_inputs, all_outputs)
+        return super().pending_ids(limit)
     
-    def run(self, id, input):
+    def _request(self, input):
         self.model = self.params.get('model')
         self.tokenizer = self.params.get('tokenizer')
         self.completion_tokenizer = build_tokenizer(self.tokenizer) if self.tokenizer else None
@@ -120,10 +321,70 @@ class StepLLMCompletion(TransformStep):
         messages = [{'role': 'user', 'content': input}]
         if self.completion_tokenizer:
             messages = [{"role": "user", "content": self.completion_tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True, bos_token='')}]
-        answers = universal_llm_request(self.completion_tokenizer != None, self.model, messages, self.sampler, 1)        
-        return answers[0], meta
+        return self.completion_tokenizer != None, messages, self.sampler, meta
+
+    def _parse(self, answer):
+        return answer
+
+    def _outputs(self, answers):
+        # n>1 asks the server for several samples sharing one prefill; each is stored under its own id
+        if self.num_samples() == 1: return self._parse(answers[0])
+        return FanOut([self._parse(answer) for answer in answers])
+
+    def num_samples(self):
+        return int(self.params.get('n', '1'))
+
+    def batch_prompts(self):
+        # batch_prompts>1 micro-batches completion-mode prompts into one /completions call, set parallel at least as high
+        return int(self.params.get('batch_prompts', '1'))
+
+    def _batched(self, completion):
+        return completion and self.batch_prompts() > 1
+
+    def _submit_batched(self, messages, sampler):
+        max_wait = float(self.params.get('batch_wait', '0.05'))
+        return batched_llm_request(self.model, messages[0]['content'], sampler, self.num_samples(), self.batch_prompts(), max_wait, self.pool())
+
+    def pool(self):
+        # pool=name routes requests across the endpoints of a pool defined with --pool name=url,url (default: OPENAI_BASE_URL)
+        return self.params.get('pool', 'llm')
+
+    def streaming(self):
+        # stream=1 consumes SSE chunks and records ttft, latency, decode_tps and usage in meta
+        return self.params.get('stream', '0') == '1'
+
+    def _llm_call(self, completion, messages, sampler, meta):
+        if self._batched(completion):
+            return self._submit_batched(messages, sampler).result()
+        if self.streaming():
+            answers, stats = universal_llm_request_stream(completion, self.model, messages, sampler, self.num_samples(), self.pool())
+            meta.update(stats)
+            return answers
+        return universal_llm_request(completion, self.model, messages, sampler, self.num_samples(), self.pool())
+
+    async def _llm_call_async(self, completion, messages, sampler, meta):
+        if self._batched(completion):
+            return await asyncio.wrap_future(self._submit_batched(messages, sampler))
+        if self.streaming():
+            answers, stats = await universal_llm_request_stream_async(completion, self.model, messages, sampler, self.num_samples(), self.pool())
+            meta.update(stats)
+            return answers
+        return await universal_llm_request_async(completion, self.model, messages, sampler, self.num_samples(), self.pool())
+
+    def run(self, id, input):
+        completion, messages, sampler, meta = self._request(input)
+        answers = self._llm_call(completion, messages, sampler, meta)
+        return self._outputs(answers), meta
+
+    async def arun(self, id, input):
+        completion, messages, sampler, meta = self._request(input)
+        answers = await self._llm_call_async(completion, messages, sampler, meta)
+        return self._outputs(answers), meta
 
 class StepJSONParser(TransformStep):
+    default_executor = 'batch'
+    deterministic = True
+
     def run(self, id, input):
         sidx = input.find('{')
         eidx = input.rfind('}')
@@ -137,12 +398,16 @@ class StepJSONParser(TransformStep):
         return data, {}
     
 class StepLLMExtraction(StepLLMCompletion):
-    def run(self, id, input):
+    # temperature 0, so outputs can be served from the output cache
+    deterministic = True
+
+    def _request(self, input):
         self.model = self.params.get('model')   
         self.schema_mode = self.params.get('schema_mode','none')
         self.max_tokens = int(self.params.get('max_tokens', '3000'))
 
         if not self.model: raise Exception(f"LLMExtraction {self.step} requires model parameter.")
+        schema_json = self.resolved_params().get('schema_json')
 
         messages = [{'role': 'user', 'content': self.params['prompt']+"\n\n"+input}]
         sampler = { 'temperature': 0.0, 'max_tokens': self.max_tokens }
@@ -150,13 +415,13 @@ class StepLLMExtraction(StepLLMCompletion):
         if self.schema_mode == "none": 
             pass
         elif self.schema_mode == "openai-schema":
-            sampler['response_format'] = { 'type': "json_schema", 'json_schema': {"strict": True, "name": "WorldList", "schema": self.params['schema_json'] } }
+            sampler['response_format'] = { 'type': "json_schema", 'json_schema': {"strict": True, "name": "WorldList", "schema": schema_json } }
         elif self.schema_mode == "openai-json":
             sampler['response_format'] = { 'type': "json_object" }
         elif self.schema_mode == "vllm":
-            sampler['guided_json'] = self.params['schema_json']
+            sampler['guided_json'] = schema_json
         elif self.schema_mode == "llama":
-            sampler['json_schema'] = self.params['schema_json']
+            sampler['json_schema'] = schema_json
         else:
             raise Exception("bad schema_mode")
 
@@ -165,13 +430,13 @@ class StepLLMExtraction(StepLLMCompletion):
             'model': self.model,
             'sampler': sampler
         }
-                    
-        answers = universal_llm_request(False, self.model, messages, sampler, 1)       
-        data = simple_extract_json(answers[0])        
-        return data, meta
+        return False, messages, sampler, meta
+
+    def _parse(self, answer):
+        return simple_extract_json(answer)
 
 class StepText2Image(TransformStep):
-    def run(self, id, input):
+    def _request(self, input):
         width = int(self.params.get('width', 512))
         height = int(self.params.get('height', 512))
         steps = int(self.params.get('steps', 20))
@@ -183,20 +448,29 @@ class StepText2Image(TransformStep):
             "height": height
         }
         
-        IMAGE_API_URL = os.getenv('IMAGE_API_URL', 'http://127.0.0.1:5001')
-        response = requests.post(url=f"{IMAGE_API_URL}/sdapi/v1/txt2img", json=payload)
-        
-        if response.status_code != 200:
-            raise Exception(f"AUTOMATIC1111 API request failed with status code {response.status_code}")
-
-        r = response.json()
-        image = r['images'][0]
-        
         meta = {
             'timestamp': time.time(),
             'width': width,
             'height': height,
-            'steps': steps
+            'steps': steps,
+            'format': 'png'
         }
 
-        return image, meta
+        # the 'image' pool is built from IMAGE_API_URL, pool=name selects another
+        return "/sdapi/v1/txt2img", payload, meta
+
+    def _parse(self, status_code, r):
+        if status_code != 200:
+            raise Exception(f"AUTOMATIC1111 API request failed with status code {status_code}")
+        # raw PNG bytes are kept out-of-row in the blob store instead of a base64 JSON string
+        return base64.b64decode(r['images'][0])
+
+    def run(self, id, input):
+        url, payload, meta = self._request(input)
+        status_code, r = post_json(url, payload, pool=get_pool(self.params.get('pool', 'image')))
+        return self._parse(status_code, r), meta
+
+    async def arun(self, id, input):
+        url, payload, meta = self._request(input)
+        status_code, r = await async_post_json(url, payload, pool=get_pool(self.params.get('pool', 'image')))
+        return self._parse(status_code, r), meta
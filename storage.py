@@ -0,0 +1,6 @@
+from base import SQLiteScribe
+from segment_log import SegmentLogScribe
+from memory_scribe import MemoryScribe
+
+# storage backends selectable with --storage
+SCRIBES = { 'sqlite': SQLiteScribe, 'log': SegmentLogScribe, 'memory': MemoryScribe }
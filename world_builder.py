@@ -1,5 +1,7 @@
 import random
 from base import SQLiteScribe
+from storage import SCRIBES
+from endpoint_pool import register_pool
 from steps import *
 
 TECHNIQUES = [
@@ -170,17 +172,21 @@ INSTRUCTIONS:
 * Make sure ALL text between relevant headings is captured.
 """
 
-from pydantic import BaseModel, Field
-from typing import List
+def world_schema():
+    # pydantic is only imported when the Extract step actually needs the schema
+    from pydantic import BaseModel, Field
+    from typing import List
 
-class World(BaseModel):
-    world_name: str = Field(description='The World Name')
-    concept: str = Field(description='The way in which the concept was applied to create this world')
-    description: str = Field(description = 'Description of the world')
-    twist: str = Field(description = 'Unique Twist that makes this world interesting')
-    story_seeds: List[str] = Field(description = 'Story ideas or conflicts that could arise in this world')
-    sensory: str = Field(description='Specific sensory information about the world')
-    challenges_opportunities: str = Field(description='Difficulties or opportunities faced by inhabitants of this world')
+    class World(BaseModel):
+        world_name: str = Field(description='The World Name')
+        concept: str = Field(description='The way in which the concept was applied to create this world')
+        description: str = Field(description = 'Description of the world')
+        twist: str = Field(description = 'Unique Twist that makes this world interesting')
+        story_seeds: List[str] = Field(description = 'Story ideas or conflicts that could arise in this world')
+        sensory: str = Field(description='Specific sensory information about the world')
+        challenges_opportunities: str = Field(description='Difficulties or opportunities faced by inhabitants of this world')
+
+    return World.model_json_schema()
 
 IMAGE_TEMPLATE = '''A movie poster with the text "{{world_name}}" at the bottom. {{description}} {{sensory}}'''
 
@@ -188,9 +194,10 @@ PIPELINE = [
   StepWorldGeneration(step='GenScenario', outkey='vars'),
   StepExpandTemplate(step='GenPrompt', inkey='vars', outkey='world_prompt', template=PROMPT_TEMPLATE),
   StepLLMCompletion(step='GenComplete', inkey='world_prompt', outkey='idea'),
-  StepLLMExtraction(step='Extract', inkey='idea', outkey='world', prompt=EXTRACTION_PROMPT, schema_json=World.model_json_schema()),
+  StepLLMExtraction(step='Extract', inkey='idea', outkey='world', prompt=EXTRACTION_PROMPT, schema_json=world_schema),
   StepExpandTemplate(step='ImagePrompt', inkey='world', outkey='img_prompt', template=IMAGE_TEMPLATE),
-  StepText2Image(step='Text2Image', inkey='img_prompt', outkey='image')
+  StepText2Image(step='Text2Image', inkey='img_prompt', outkey='image'),
+  StepBulkExport(step='BulkExport', inkey='world', keys='vars,world', meta='idea')
 ]
     
 if __name__ == "__main__":
@@ -200,12 +207,21 @@ if __name__ == "__main__":
     parser.add_argument("--watch", action="store_true", help="Watch mode")
     parser.add_argument("--project", type=str, required=True, help="Project name")
     parser.add_argument("--step", action="append", nargs="+", help="Steps to run")
+    parser.add_argument("--cache", nargs="?", const="", default=None, help="Reuse outputs of deterministic steps from a shared cache (optional path)")
+    parser.add_argument("--pool", action="append", help="Endpoint pool as name=[least:|wrr:]url[*weight],url,... (steps select it with pool=name)")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Serve live metrics on this port (/metrics and /metrics.json)")
+    parser.add_argument("--storage", choices=list(SCRIBES.keys()), default="sqlite", help="Storage backend: sqlite ({project}.db), log (append-only segments in {project}.log/, single process) or memory (flushed to {project}.db every SCRIBE_FLUSH_INTERVAL seconds and at shutdown)")
+    parser.add_argument("--schedule", choices=["depth", "breadth"], default="depth", help="depth: finish samples before generating more (generators wait at watermark=), breadth: fill every step in order")
     args = parser.parse_args()
 
     if not args.step: raise Exception("At least one --step is required.")
 
     try:
-      scr = SQLiteScribe(args.project)
+      scr = SCRIBES[args.storage](args.project)
+      for pool in args.pool or []: register_pool(*pool.split('=', 1))
+      if args.cache is not None: scr.enable_cache(args.cache or None)
+      if args.metrics_port is not None: scr.serve_metrics(args.metrics_port)
+      scr.schedule = args.schedule
       scr.init_pipeline(args.step, PIPELINE)       
       scr.run_all_steps()
     finally: